@@ -0,0 +1,48 @@
+import argparse
+import time
+from pathlib import Path
+from typing import Optional, Tuple
+
+from PIL import Image
+
+from finder.processing.loading import DRAFT_SIZE, open_image
+from finder.utils.utils import list_files, image_extensions
+
+
+def time_decoding(paths, draft_size: Optional[Tuple[int, int]], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            open_image(path, draft_size).resize((256, 256))
+        best = min(best, time.perf_counter() - start)
+
+    return best / len(paths)
+
+
+def create_sample(directory: Path, size: Tuple[int, int]) -> Path:
+    # A noisy gradient compresses like a photo far better than a flat color would
+    path = directory / f"sample_{size[0]}x{size[1]}.jpeg"
+    if not path.exists():
+        gradient = Image.linear_gradient("L").resize(size)
+        noise = Image.effect_noise(size, 64)
+        Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT))).save(path, quality=90)
+
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare full and draft mode decoding of the images fed to the model.")
+    parser.add_argument("images_dir", type=Path, help="Directory of images to decode (a sample JPEG is created if empty).")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs, the fastest one is reported.")
+    args = parser.parse_args()
+
+    args.images_dir.mkdir(parents=True, exist_ok=True)
+    images = list_files(args.images_dir, image_extensions) or [create_sample(args.images_dir, (4000, 3000))]
+
+    full = time_decoding(images, None, args.repeat)
+    draft = time_decoding(images, DRAFT_SIZE, args.repeat)
+
+    print(f"{len(images)} image(s)")
+    print(f"full decode + resize:  {full * 1000:.1f} ms/image")
+    print(f"draft decode + resize: {draft * 1000:.1f} ms/image ({full / draft:.1f}x faster)")
@@ -0,0 +1,57 @@
+import argparse
+import copy
+import time
+from typing import Sequence
+
+import torch
+
+from finder.backends.base import InferenceBackend
+from finder.backends.factory import create_backend
+from finder.processing.features import FeaturesExtractor
+
+
+def images_per_second(backend: InferenceBackend, batch_size: int, repeat: int) -> float:
+    batch = torch.randn(batch_size, 3, 256, 256)
+    backend.warmup(2, (batch_size,))
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        backend.run(batch)
+
+    return batch_size * repeat / (time.perf_counter() - start)
+
+
+def run_benchmark(backends: Sequence[str], batch_sizes: Sequence[int], layer: str, repeat: int) -> None:
+    extractor = FeaturesExtractor(layer)
+    cpu = torch.device("cpu")
+
+    print(f"{'backend':<26}" + "".join(f"{f'batch {size}':>12}" for size in batch_sizes) + "   (images/s)")
+    for name in backends:
+        for channels_last in (False, True):
+            backend = create_backend(
+                name,
+                copy.deepcopy(extractor.model),
+                version=extractor.version,
+                device=cpu,
+                preprocess=extractor.preprocess,
+                channels_last=channels_last
+            )
+            rates = [images_per_second(backend, size, repeat) for size in batch_sizes]
+
+            label = f"{name} ({'channels_last' if channels_last else 'NCHW'})"
+            print(f"{label:<26}" + "".join(f"{rate:>12.1f}" for rate in rates))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare CPU inference throughput of the NCHW and channels_last layouts.")
+    parser.add_argument("--backends", nargs="+", choices=["torch", "torchscript"], default=["torch", "torchscript"])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--layer", choices=FeaturesExtractor.LAYERS, default="fc")
+    parser.add_argument("--repeat", type=int, default=10, help="Timed batches per batch size.")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads (default: torch's choice).")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    run_benchmark(args.backends, args.batch_sizes, args.layer, args.repeat)
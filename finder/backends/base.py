@@ -0,0 +1,36 @@
+from abc import ABC, abstractmethod
+from typing import Callable, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+from torch import nn
+
+Preprocess = Callable[[Sequence[Image.Image]], torch.Tensor]
+
+
+class InferenceBackend(ABC):
+    # Runs the feature model on preprocessed (B, 3, H, W) float32 batches and returns one row per image.
+    # Every backend is built from the same PyTorch model, so they all produce the same feature space,
+    # except approximate backends which set VERSION_SUFFIX to keep their features apart.
+
+    VERSION_SUFFIX: Optional[str] = None
+    # Backends running the model outside of PyTorch size their own thread pool from `intra_op_threads`
+    OWN_THREAD_POOL: bool = False
+
+    def __init__(self, model: nn.Module, *, version: str, device: torch.device, preprocess: Preprocess):
+        self.version = version
+        self.device = device
+        self.preprocess = preprocess  # turns images into the batches given to `run`
+
+    @abstractmethod
+    def run(self, batch: torch.Tensor) -> np.ndarray:
+        ...
+
+    def warmup(self, passes: int, batch_sizes: Sequence[int] = (1,), input_size: Tuple[int, int] = (256, 256)) -> None:
+        # The first passes pay for graph optimizations, allocator growth and kernel selection;
+        # running them on dummy batches keeps that cost away from the first real requests
+        for batch_size in batch_sizes:
+            batch = torch.zeros(batch_size, 3, *input_size)
+            for _ in range(passes):
+                self.run(batch)
@@ -0,0 +1,33 @@
+from typing import Dict, Type
+
+import torch
+from torch import nn
+
+from finder.backends.base import InferenceBackend, Preprocess
+from finder.backends.onnx_runtime import OnnxBackend
+from finder.backends.pytorch import TorchBackend
+from finder.backends.quantized import Int8Backend
+from finder.backends.torchscript import TorchScriptBackend
+
+BACKENDS: Dict[str, Type[InferenceBackend]] = {
+    "torch": TorchBackend,
+    "torchscript": TorchScriptBackend,
+    "onnx": OnnxBackend,
+    "int8": Int8Backend,
+}
+
+
+def create_backend(
+        backend: str,
+        model: nn.Module,
+        *,
+        version: str,
+        device: torch.device,
+        preprocess: Preprocess,
+        **kwargs
+) -> InferenceBackend:
+    backend_cls = BACKENDS.get(backend.lower())
+    if backend_cls is None:
+        raise ValueError(f"Unknown inference backend '{backend}'. Available backends: {', '.join(BACKENDS)}.")
+
+    return backend_cls(model, version=version, device=device, preprocess=preprocess, **kwargs)
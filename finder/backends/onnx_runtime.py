@@ -0,0 +1,87 @@
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+from torch import nn
+
+from finder.backends.base import InferenceBackend, Preprocess
+from finder.utils.utils import FilePath
+
+_VERSION_KEY: str = "finder_version"
+
+
+class OnnxBackend(InferenceBackend):
+    # ONNX Runtime on the CPU with every graph optimization enabled (operator fusion, constant folding,
+    # layout transformations). The model is exported once to `path` and reused on the next starts;
+    # an export made for another feature version is replaced.
+
+    OWN_THREAD_POOL = True
+
+    def __init__(
+            self,
+            model: nn.Module,
+            *,
+            version: str,
+            device: torch.device,
+            preprocess: Preprocess,
+            path: Optional[FilePath] = None,
+            intra_op_threads: Optional[int] = None,
+            input_size: Tuple[int, int] = (256, 256)
+    ):
+        # onnxruntime is optional and only needed by this backend
+        import onnxruntime as ort
+
+        super().__init__(model, version=version, device=torch.device("cpu"), preprocess=preprocess)
+        self.path = Path(path) if path is not None else Path(tempfile.gettempdir()) / f"finder-{version}.onnx"
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+
+        session = None
+        if self.path.exists():
+            session = ort.InferenceSession(str(self.path), options, providers=["CPUExecutionProvider"])
+
+        if session is None or session.get_modelmeta().custom_metadata_map.get(_VERSION_KEY) != version:
+            self.export(model, self.path, version, input_size)
+            session = ort.InferenceSession(str(self.path), options, providers=["CPUExecutionProvider"])
+
+        self.session = session
+        self._input_name = self.session.get_inputs()[0].name
+
+    def run(self, batch: torch.Tensor) -> np.ndarray:
+        features = self.session.run(None, {self._input_name: batch.cpu().numpy()})[0]
+        return features.reshape(features.shape[0], -1)
+
+    @staticmethod
+    def export(model: nn.Module, path: Path, version: str, input_size: Tuple[int, int] = (256, 256)) -> None:
+        import onnx
+
+        model = model.to("cpu").eval()
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Inference workers may export the same model at once, so the file only appears once it is complete
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+        os.close(fd)
+
+        try:
+            torch.onnx.export(
+                model,
+                torch.zeros(1, 3, *input_size),
+                temp_path,
+                input_names=["images"],
+                output_names=["features"],
+                dynamic_axes={"images": {0: "batch"}, "features": {0: "batch"}},
+            )
+
+            exported = onnx.load(temp_path)
+            onnx.helper.set_model_props(exported, {_VERSION_KEY: version})
+            onnx.save(exported, temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
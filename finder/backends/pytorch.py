@@ -0,0 +1,27 @@
+import numpy as np
+import torch
+from torch import nn
+
+from finder.backends.base import InferenceBackend, Preprocess
+
+
+class TorchBackend(InferenceBackend):
+    # Eager PyTorch, on the GPU when one is available. With `channels_last`, weights and inputs are laid out
+    # NHWC, the layout oneDNN's convolution kernels work in, which avoids reordering tensors on every layer.
+
+    def __init__(
+            self,
+            model: nn.Module,
+            *,
+            version: str,
+            device: torch.device,
+            preprocess: Preprocess,
+            channels_last: bool = False
+    ):
+        super().__init__(model, version=version, device=device, preprocess=preprocess)
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.model = model.to(device, memory_format=self.memory_format).eval()
+
+    def run(self, batch: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            return self.model(batch.to(self.device, memory_format=self.memory_format)).flatten(1).cpu().numpy()
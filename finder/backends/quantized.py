@@ -0,0 +1,84 @@
+import copy
+from typing import List, Sequence
+
+import numpy as np
+import torch
+from torch import nn
+
+from finder.backends.base import InferenceBackend, Preprocess
+from finder.processing.loading import open_image
+from finder.processing.similarity import compare_features
+from finder.utils.utils import FilePath
+
+
+class Int8Backend(InferenceBackend):
+    # Post-training static int8 quantization (FX graph mode) for CPU serving: convolutions and linear
+    # layers run with int8 weights and activations, whose ranges are calibrated on sample images of the
+    # library, which cuts inference time and makes the model about 4x smaller. Without calibration
+    # images only the linear layers can be quantized (dynamic quantization).
+    # Quantized features only approximate the float32 ones, so they are versioned apart.
+
+    VERSION_SUFFIX = "int8"
+
+    def __init__(
+            self,
+            model: nn.Module,
+            *,
+            version: str,
+            device: torch.device,
+            preprocess: Preprocess,
+            calibration_images: Sequence[FilePath] = (),
+            validation_images: Sequence[FilePath] = (),
+            batch_size: int = 16,
+            engine: str = "x86"
+    ):
+        from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        # Quantized kernels only run on the CPU
+        super().__init__(model, version=version, device=torch.device("cpu"), preprocess=preprocess)
+
+        if engine not in torch.backends.quantized.supported_engines:
+            engine = "fbgemm" if "fbgemm" in torch.backends.quantized.supported_engines else "qnnpack"
+        torch.backends.quantized.engine = engine
+
+        # The float model is left untouched, to measure the drift of the quantized one against it
+        float_model = copy.deepcopy(model).to(self.device).eval()
+
+        if not calibration_images:
+            self.model = quantize_dynamic(float_model, {nn.Linear}, dtype=torch.qint8)
+            return
+
+        batches = self._load_batches(calibration_images, batch_size)
+
+        prepared = prepare_fx(copy.deepcopy(float_model), get_default_qconfig_mapping(engine), (batches[0][:1],))
+        with torch.no_grad():
+            for batch in batches:
+                prepared(batch)
+
+        self.model = convert_fx(prepared)
+
+        # Report how far the quantized features are from the float32 ones, on images the calibration has not seen
+        if len(validation_images) < 2:
+            print(f"int8 model calibrated on {len(calibration_images)} image(s), too few images left to measure drift.")
+            return
+
+        validation = torch.cat(self._load_batches(validation_images, batch_size))
+        with torch.no_grad():
+            expected = float_model(validation).flatten(1).numpy()
+
+        drift = compare_features(expected, self.run(validation))
+        print(
+            f"int8 model calibrated on {len(calibration_images)} image(s), drift on {len(validation)} other image(s): "
+            + ", ".join(f"{name} {value:.4g}" for name, value in drift.items())
+        )
+
+    def _load_batches(self, images: Sequence[FilePath], batch_size: int) -> List[torch.Tensor]:
+        return [
+            self.preprocess([open_image(path) for path in images[start:start + batch_size]])
+            for start in range(0, len(images), batch_size)
+        ]
+
+    def run(self, batch: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            return self.model(batch.to(self.device)).flatten(1).numpy()
@@ -0,0 +1,74 @@
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+from torch import nn
+
+from finder.backends.base import InferenceBackend, Preprocess
+from finder.utils.utils import FilePath
+
+
+class TorchScriptBackend(InferenceBackend):
+    # The model traced once to TorchScript, frozen (weights become constants and batch norms are folded
+    # into the convolutions) and optimized for inference. The result is saved in `cache_dir` under a name
+    # made of the feature version, the torch version and the device, so later starts only load it.
+    # `channels_last` traces the model with NHWC weights and inputs and, on the CPU, enables the oneDNN
+    # fusion pass of the TorchScript JIT (convolutions fused with their activations and additions).
+
+    def __init__(
+            self,
+            model: nn.Module,
+            *,
+            version: str,
+            device: torch.device,
+            preprocess: Preprocess,
+            cache_dir: Optional[FilePath] = None,
+            input_size: Tuple[int, int] = (256, 256),
+            channels_last: bool = False
+    ):
+        super().__init__(model, version=version, device=device, preprocess=preprocess)
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+
+        if channels_last and device.type == "cpu":
+            torch.jit.enable_onednn_fusion(True)
+
+        cache_dir = Path(cache_dir) if cache_dir is not None else Path(tempfile.gettempdir())
+        layout = "-channels_last" if channels_last else ""
+        self.path = cache_dir / f"finder-{version}-torch{torch.__version__}-{device.type}{layout}.pt"
+
+        if self.path.exists():
+            self.model = torch.jit.load(str(self.path), map_location=device)
+        else:
+            self.model = self.compile(
+                model.to(device, memory_format=self.memory_format).eval(),
+                torch.zeros(1, 3, *input_size, device=device).contiguous(memory_format=self.memory_format)
+            )
+            self.save(self.model, self.path)
+
+    @staticmethod
+    def compile(model: nn.Module, example: torch.Tensor) -> torch.jit.ScriptModule:
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+            return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+    @staticmethod
+    def save(model: torch.jit.ScriptModule, path: Path) -> None:
+        # Several processes (e.g. inference workers) may compile the same model at once, so each one writes
+        # a temporary file and renames it: readers only ever load a complete file
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+        os.close(fd)
+
+        try:
+            torch.jit.save(model, temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def run(self, batch: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            return self.model(batch.to(self.device, memory_format=self.memory_format)).flatten(1).cpu().numpy()
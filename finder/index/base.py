@@ -0,0 +1,99 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Mapping, Optional, List, Tuple
+
+import numpy as np
+
+from finder.processing.matrix import FeatureMatrix
+from finder.processing.similarity import calc_similarities
+from finder.utils.utils import FilePath
+
+
+class VectorIndex(ABC):
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    @abstractmethod
+    def __contains__(self, path: object) -> bool:
+        ...
+
+    @abstractmethod
+    def add(self, path: Path, vector: np.ndarray) -> None:
+        ...
+
+    @abstractmethod
+    def remove(self, path: Path) -> None:
+        ...
+
+    @abstractmethod
+    def search(
+            self,
+            reference_vector: np.ndarray,
+            *,
+            top_k: Optional[int] = None,
+            min_similarity: Optional[float] = 0.2,
+            max_similarity: Optional[float] = 0.9,
+            cosine_penalty_factor: float = 4,
+            euclidean_penalty_factor: float = 0.2,
+            **params
+    ) -> List[Tuple[FilePath, float]]:
+        ...
+
+
+class ShortlistIndex(VectorIndex, ABC):
+    def __init__(self, vectors: Optional[Mapping[Path, np.ndarray]] = None):
+        # Raw vectors are always kept so that every shortlist is re-scored with the exact formula
+        self.vectors: FeatureMatrix = vectors if isinstance(vectors, FeatureMatrix) else FeatureMatrix(vectors)
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def __contains__(self, path: object) -> bool:
+        return path in self.vectors
+
+    def add(self, path: Path, vector: np.ndarray) -> None:
+        if path in self.vectors:
+            self.remove(path)
+
+        self.vectors[path] = vector
+        self._add(path, self.vectors[path])
+
+    def remove(self, path: Path) -> None:
+        self._remove(path)
+        del self.vectors[path]
+
+    def search(
+            self,
+            reference_vector: np.ndarray,
+            *,
+            top_k: Optional[int] = None,
+            min_similarity: Optional[float] = 0.2,
+            max_similarity: Optional[float] = 0.9,
+            cosine_penalty_factor: float = 4,
+            euclidean_penalty_factor: float = 0.2,
+            **params
+    ) -> List[Tuple[FilePath, float]]:
+        shortlist = self.shortlist(reference_vector, top_k, **params)
+
+        return calc_similarities(
+            reference_vector,
+            shortlist,
+            min_similarity=min_similarity,
+            max_similarity=max_similarity,
+            top_k=top_k,
+            cosine_penalty_factor=cosine_penalty_factor,
+            euclidean_penalty_factor=euclidean_penalty_factor
+        )
+
+    @abstractmethod
+    def shortlist(self, reference_vector: np.ndarray, top_k: Optional[int], **params) -> FeatureMatrix:
+        ...
+
+    @abstractmethod
+    def _add(self, path: Path, vector: np.ndarray) -> None:
+        ...
+
+    @abstractmethod
+    def _remove(self, path: Path) -> None:
+        ...
@@ -0,0 +1,25 @@
+from pathlib import Path
+from typing import Dict, Mapping, Optional, Type
+
+import numpy as np
+
+from finder.index.base import VectorIndex
+from finder.index.flat import FlatIndex
+from finder.index.hnsw import HNSWIndex
+from finder.index.ivf import IVFIndex
+from finder.index.pq import PQIndex
+
+INDEX_TYPES: Dict[str, Type[VectorIndex]] = {
+    "flat": FlatIndex,
+    "hnsw": HNSWIndex,
+    "ivf": IVFIndex,
+    "pq": PQIndex,
+}
+
+
+def create_index(index_type: str, vectors: Optional[Mapping[Path, np.ndarray]] = None, **kwargs) -> VectorIndex:
+    index_cls = INDEX_TYPES.get(index_type.lower())
+    if index_cls is None:
+        raise ValueError(f"Unknown index type '{index_type}'. Available types: {', '.join(INDEX_TYPES)}.")
+
+    return index_cls(vectors, **kwargs)
@@ -0,0 +1,20 @@
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from finder.index.base import ShortlistIndex
+from finder.processing.matrix import FeatureMatrix
+
+
+class FlatIndex(ShortlistIndex):
+    # Exact brute-force search: the shortlist is the whole library
+
+    def shortlist(self, reference_vector: np.ndarray, top_k: Optional[int], **params) -> FeatureMatrix:
+        return self.vectors
+
+    def _add(self, path: Path, vector: np.ndarray) -> None:
+        pass
+
+    def _remove(self, path: Path) -> None:
+        pass
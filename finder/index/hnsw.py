@@ -0,0 +1,304 @@
+import heapq
+import math
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Set, Tuple
+
+import numpy as np
+
+from finder.index.base import ShortlistIndex
+from finder.processing.matrix import FeatureMatrix
+from finder.utils.utils import FilePath
+
+
+class HNSWIndex(ShortlistIndex):
+    # Hierarchical Navigable Small World graph over cosine distance.
+    # Removed images stay in the graph as tombstones so it remains navigable, but are never returned.
+    # Building the graph is slow (pure Python), so it can be saved to `graph` and loaded on the next start:
+    # only the images added, changed or removed since then are inserted or turned into tombstones.
+
+    def __init__(
+            self,
+            vectors: Optional[Mapping[Path, np.ndarray]] = None,
+            *,
+            graph: Optional[FilePath] = None,
+            m: int = 16,
+            ef_construction: int = 200,
+            ef_search: int = 64,
+            seed: Optional[int] = None
+    ):
+        super().__init__(vectors)
+
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self._level_mult = 1 / math.log(m)
+        self._rng = np.random.default_rng(seed)
+
+        self._data: np.ndarray = np.empty((0, self.vectors.dim or 0), dtype=np.float32)
+        self._links: List[List[List[int]]] = []
+        self._node_paths: List[Optional[Path]] = []
+        self._nodes: Dict[Path, int] = {}
+        self._deleted: Set[int] = set()
+        self._entry: Optional[int] = None
+        self._max_level: int = -1
+        self.modified: bool = False  # since the graph was loaded or saved
+
+        # A saved graph is only worth loading for vectors to attach it to
+        graph_path = Path(graph) if graph is not None else None
+        if graph_path is not None and graph_path.exists() and len(self.vectors):
+            self._load_graph(graph_path)
+
+        self.sync()
+
+    def sync(self) -> None:
+        # Brings the graph up to date with the vectors, e.g. after loading a saved graph or when the vectors were
+        # changed directly (by another index sharing them): removed images become tombstones and missing ones
+        # are inserted
+        for path in [path for path in self._nodes if path not in self.vectors]:
+            self._remove(path)
+
+        for path in list(self.vectors):
+            if path in self._nodes:
+                continue
+
+            try:
+                vector = self.vectors[path]
+            except KeyError:
+                continue  # removed meanwhile
+
+            self._add(path, vector)
+
+    def save(self, path: FilePath) -> None:
+        self.write(path, self.snapshot())
+
+    def snapshot(self) -> Dict[str, np.ndarray]:
+        # Copy of the graph as arrays, the (ragged) links of every layer of every node are concatenated
+        size = len(self._node_paths)
+        self.modified = False
+
+        return {
+            "data": self._data[:size].copy(),
+            "paths": np.array([str(path) for path in self._node_paths]),
+            "levels": np.array([len(links) - 1 for links in self._links], dtype=np.int32),
+            "degrees": np.array([len(layer) for links in self._links for layer in links], dtype=np.int32),
+            "links": np.array([node for links in self._links for layer in links for node in layer], dtype=np.int32),
+            "deleted": np.array(sorted(self._deleted), dtype=np.int64),
+            "entry": np.array(-1 if self._entry is None else self._entry),
+            "max_level": np.array(self._max_level),
+        }
+
+    @staticmethod
+    def write(path: FilePath, snapshot: Dict[str, np.ndarray]) -> None:
+        # Written aside and renamed, so a crash never leaves a truncated graph behind
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "wb") as file:
+                np.savez(file, **snapshot)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def shortlist(
+            self,
+            reference_vector: np.ndarray,
+            top_k: Optional[int],
+            *,
+            ef_search: Optional[int] = None,
+            **params
+    ) -> FeatureMatrix:
+        if self._entry is None:
+            return FeatureMatrix(dim=self.vectors.dim)
+
+        # ef_search is the recall/latency knob: the size of the candidate list kept while walking layer 0
+        ef = max(ef_search or self.ef_search, top_k or 1)
+        query = self._normalize(reference_vector)
+
+        entry = self._descend(query, 0)
+        found = self._search_layer(query, [entry], ef, 0)
+
+        return self.vectors.subset(
+            self._node_paths[node] for _, node in found if node not in self._deleted
+        )
+
+    def _add(self, path: Path, vector: np.ndarray) -> None:
+        node = self._new_node(path, vector)
+        query = self._data[node]
+        level = len(self._links[node]) - 1
+
+        if self._entry is None:
+            self._entry, self._max_level = node, level
+            return
+
+        entry = self._descend(query, level + 1)
+        entry_points = [entry]
+
+        for layer in range(min(level, self._max_level), -1, -1):
+            found = self._search_layer(query, entry_points, self.ef_construction, layer)
+            max_links = self._max_links(layer)
+            neighbours = self._select_neighbours(found, max_links)
+            self._links[node][layer] = neighbours
+
+            for neighbour in neighbours:
+                links = self._links[neighbour][layer]
+                links.append(node)
+
+                if len(links) > max_links:
+                    # Shrink the neighbour's connections back down to the allowed degree
+                    distances = self._distances(self._data[neighbour], links)
+                    self._links[neighbour][layer] = self._select_neighbours(
+                        sorted(zip(distances.tolist(), links)), max_links
+                    )
+
+            entry_points = [candidate for _, candidate in found]
+
+        if level > self._max_level:
+            self._entry, self._max_level = node, level
+
+    def _remove(self, path: Path) -> None:
+        node = self._nodes.pop(path, None)
+        if node is not None:
+            self._deleted.add(node)
+            self.modified = True
+
+    def _load_graph(self, path: Path) -> None:
+        with np.load(path) as saved:
+            data = saved["data"]
+            dim = self.vectors.dim
+            if dim is not None and data.shape[1] != dim:
+                raise ValueError(
+                    f"The HNSW graph at {path} has dimension {data.shape[1]}, expected {dim}; "
+                    f"delete it to build it again for the current features."
+                )
+
+            degrees = iter(saved["degrees"].tolist())
+            links = saved["links"].tolist()
+            start = 0
+            self._links = []
+
+            for level in saved["levels"].tolist():
+                node_links = []
+                for _ in range(level + 1):
+                    end = start + next(degrees)
+                    node_links.append(links[start:end])
+                    start = end
+
+                self._links.append(node_links)
+
+            self._data = data
+            self._node_paths = [Path(name) for name in saved["paths"].tolist()]
+            self._deleted = set(saved["deleted"].tolist())
+            self._nodes = {
+                node_path: node for node, node_path in enumerate(self._node_paths) if node not in self._deleted
+            }
+            self._entry = None if int(saved["entry"]) < 0 else int(saved["entry"])
+            self._max_level = int(saved["max_level"])
+
+        # Images whose features changed since the graph was saved are inserted again by sync
+        for node_path, node in list(self._nodes.items()):
+            if node_path in self.vectors and not np.allclose(
+                    self._data[node], self._normalize(self.vectors[node_path]), atol=1e-5
+            ):
+                self._remove(node_path)
+
+        self.modified = False
+
+    def _new_node(self, path: Path, vector: np.ndarray) -> int:
+        node = len(self._node_paths)
+        self.modified = True
+
+        if node >= self._data.shape[0]:
+            data = np.empty((max(1024, node * 2), vector.shape[0]), dtype=np.float32)
+            data[:node] = self._data[:node]
+            self._data = data
+
+        self._data[node] = self._normalize(vector)
+        self._node_paths.append(path)
+        self._nodes[path] = node
+
+        level = int(-math.log(1 - self._rng.random()) * self._level_mult)
+        self._links.append([[] for _ in range(level + 1)])
+
+        return node
+
+    def _descend(self, query: np.ndarray, stop_level: int) -> int:
+        # Greedy walk through the upper layers to find a good entry point for the lower ones
+        entry = self._entry
+        for layer in range(self._max_level, stop_level - 1, -1):
+            entry = self._search_layer(query, [entry], 1, layer)[0][1]
+
+        return entry
+
+    def _search_layer(self, query: np.ndarray, entry_points: List[int], ef: int, layer: int) -> List[Tuple[float, int]]:
+        visited = set(entry_points)
+        distances = self._distances(query, entry_points).tolist()
+
+        candidates = list(zip(distances, entry_points))
+        heapq.heapify(candidates)
+        results = [(-distance, node) for distance, node in candidates]
+        heapq.heapify(results)
+
+        while candidates:
+            distance, node = heapq.heappop(candidates)
+            if len(results) >= ef and distance > -results[0][0]:
+                break
+
+            neighbours = [neighbour for neighbour in self._links[node][layer] if neighbour not in visited]
+            if not neighbours:
+                continue
+
+            visited.update(neighbours)
+            for neighbour_distance, neighbour in zip(self._distances(query, neighbours).tolist(), neighbours):
+                if len(results) < ef or neighbour_distance < -results[0][0]:
+                    heapq.heappush(candidates, (neighbour_distance, neighbour))
+                    heapq.heappush(results, (-neighbour_distance, neighbour))
+
+                    if len(results) > ef:
+                        heapq.heappop(results)
+
+        return sorted((-distance, node) for distance, node in results)
+
+    def _select_neighbours(self, candidates: List[Tuple[float, int]], max_links: int) -> List[int]:
+        # Prefer candidates that are closer to the new node than to any neighbour already picked,
+        # which keeps links spread across directions; pruned candidates fill any remaining slots
+        if len(candidates) <= max_links:
+            return [candidate for _, candidate in candidates]
+
+        nodes = [candidate for _, candidate in candidates]
+        vectors = self._data[nodes]
+        pairwise = 1 - vectors @ vectors.T
+
+        # Distance from every candidate to its closest already selected neighbour
+        closest = np.full(len(nodes), np.inf, dtype=np.float32)
+        selected: List[int] = []
+        pruned: List[int] = []
+
+        for position, (distance, _) in enumerate(candidates):
+            if len(selected) >= max_links:
+                break
+
+            if closest[position] < distance:
+                pruned.append(position)
+                continue
+
+            selected.append(position)
+            np.minimum(closest, pairwise[position], out=closest)
+
+        return [nodes[position] for position in selected + pruned[:max_links - len(selected)]]
+
+    def _distances(self, query: np.ndarray, nodes: List[int]) -> np.ndarray:
+        return 1 - self._data[nodes] @ query
+
+    def _max_links(self, layer: int) -> int:
+        return self.m * 2 if layer == 0 else self.m
+
+    @staticmethod
+    def _normalize(vector: np.ndarray) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
@@ -0,0 +1,131 @@
+import argparse
+import math
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional
+
+import numpy as np
+
+from finder.index.base import ShortlistIndex
+from finder.index.kmeans import assign_clusters, kmeans, normalize_rows
+from finder.processing.loading import load_cached_features
+from finder.processing.matrix import FeatureMatrix
+from finder.utils.utils import FilePath
+
+
+class IVFIndex(ShortlistIndex):
+    # Inverted file index: every image belongs to the list of its closest centroid,
+    # and queries only scan the `nprobe` lists whose centroids are closest to them.
+
+    def __init__(
+            self,
+            vectors: Optional[Mapping[Path, np.ndarray]] = None,
+            *,
+            centroids: np.ndarray | FilePath | None = None,
+            n_lists: Optional[int] = None,
+            nprobe: int = 8,
+            dim: Optional[int] = None,
+            seed: Optional[int] = None
+    ):
+        super().__init__(vectors)
+
+        self.nprobe = nprobe
+        self._assignment: Dict[Path, int] = {}
+        self._lists: List[Dict[Path, None]] = []
+        self.centroids: Optional[np.ndarray] = None
+
+        centroids_path = Path(centroids) if isinstance(centroids, (str, Path)) else None
+        if centroids_path is not None:
+            centroids = np.load(centroids_path) if centroids_path.exists() else None
+
+        # Centroids trained on other features (e.g. another layer) must be rejected before anything is assigned
+        dim = dim or self.vectors.dim
+        if isinstance(centroids, np.ndarray) and dim is not None and centroids.shape[1] != dim:
+            raise ValueError(
+                f"The IVF centroids{f' at {centroids_path}' if centroids_path else ''} have dimension "
+                f"{centroids.shape[1]}, expected {dim}; train them again for the current features."
+            )
+
+        if isinstance(centroids, np.ndarray):
+            self.centroids = normalize_rows(centroids)
+
+        elif len(self.vectors):
+            # No trained centroids yet: train on the library itself and persist them if a path was given
+            n_lists = n_lists or max(1, int(math.sqrt(len(self.vectors))))
+            self.centroids = kmeans(self.vectors.matrix[self.vectors.valid], n_lists, seed=seed)
+
+            if centroids_path is not None:
+                self.save(centroids_path)
+
+        if self.centroids is not None:
+            self._lists = [{} for _ in range(self.centroids.shape[0])]
+            self._assign_all()
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def save(self, path: FilePath) -> None:
+        if not self.trained:
+            raise ValueError("Cannot save an IVF index that has not been trained.")
+
+        np.save(path, self.centroids)
+
+    def shortlist(
+            self,
+            reference_vector: np.ndarray,
+            top_k: Optional[int],
+            *,
+            nprobe: Optional[int] = None,
+            **params
+    ) -> FeatureMatrix:
+        # Until centroids are available the index behaves like a flat scan
+        if not self.trained:
+            return self.vectors
+
+        nprobe = min(nprobe or self.nprobe, len(self._lists))
+        scores = self.centroids @ normalize_rows(np.asarray(reference_vector).ravel())
+        probed = np.argpartition(-scores, nprobe - 1)[:nprobe]
+
+        return self.vectors.subset(path for list_id in probed for path in self._lists[list_id])
+
+    def _add(self, path: Path, vector: np.ndarray) -> None:
+        if not self.trained:
+            return
+
+        list_id = int(np.argmax(self.centroids @ normalize_rows(vector)))
+        self._assignment[path] = list_id
+        self._lists[list_id][path] = None
+
+    def _remove(self, path: Path) -> None:
+        list_id = self._assignment.pop(path, None)
+        if list_id is not None:
+            del self._lists[list_id][path]
+
+    def _assign_all(self) -> None:
+        paths = list(self.vectors)
+        if not paths:
+            return
+
+        assignment = assign_clusters(normalize_rows(self.vectors.matrix[self.vectors.valid]), self.centroids)
+        for path, list_id in zip(paths, assignment.tolist()):
+            self._assignment[path] = list_id
+            self._lists[list_id][path] = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train IVF centroids from the cached image features.")
+    parser.add_argument("cache_dir", type=Path, help="Directory containing the cached .npy features.")
+    parser.add_argument("output", type=Path, help="Where to save the trained centroids (.npy).")
+    parser.add_argument("--n-lists", type=int, default=None, help="Number of lists (default: sqrt of the library size).")
+    parser.add_argument("--n-iter", type=int, default=20, help="Number of k-means iterations.")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    features = load_cached_features(args.cache_dir)
+    print(f"Training IVF centroids on {features.shape[0]} vector(s)...")
+
+    trained = kmeans(
+        features, args.n_lists or max(1, int(math.sqrt(features.shape[0]))), n_iter=args.n_iter, seed=args.seed
+    )
+    np.save(args.output, trained)
+    print(f"Saved {trained.shape[0]} centroid(s) to {args.output}")
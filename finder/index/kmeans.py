@@ -0,0 +1,65 @@
+from typing import Optional
+
+import numpy as np
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def assign_clusters(
+        data: np.ndarray,
+        centroids: np.ndarray,
+        *,
+        spherical: bool = True,
+        chunk_size: int = 16 * 1024
+) -> np.ndarray:
+    # Spherical clusters are matched by cosine similarity, the others by euclidean distance
+    half_norms = None if spherical else (centroids ** 2).sum(axis=1) / 2
+
+    assignment = np.empty(data.shape[0], dtype=np.int64)
+    for start in range(0, data.shape[0], chunk_size):
+        scores = data[start:start + chunk_size] @ centroids.T
+        if half_norms is not None:
+            scores -= half_norms
+
+        assignment[start:start + chunk_size] = np.argmax(scores, axis=1)
+
+    return assignment
+
+
+def kmeans(
+        data: np.ndarray,
+        n_clusters: int,
+        *,
+        spherical: bool = True,
+        n_iter: int = 20,
+        max_samples: int = 256 * 1024,
+        seed: Optional[int] = None
+) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    data = normalize_rows(data) if spherical else np.asarray(data, dtype=np.float32)
+
+    if data.shape[0] > max_samples:
+        data = data[rng.choice(data.shape[0], max_samples, replace=False)]
+
+    n_clusters = min(n_clusters, data.shape[0])
+    centroids = data[rng.choice(data.shape[0], n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignment = assign_clusters(data, centroids, spherical=spherical)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        counts = np.bincount(assignment, minlength=n_clusters)
+
+        # Re-seed empty clusters with random points so every cluster stays in use
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = data[rng.choice(data.shape[0], empty.size, replace=False)]
+        counts[empty] = 1
+
+        centroids = normalize_rows(sums) if spherical else sums / counts[:, None]
+
+    return centroids
@@ -0,0 +1,323 @@
+import argparse
+import math
+from pathlib import Path
+from typing import Dict, List, Mapping, MutableMapping, Optional, Tuple
+
+import numpy as np
+
+from finder.index.base import VectorIndex
+from finder.index.kmeans import assign_clusters, kmeans
+from finder.processing.loading import CachedFeatures
+from finder.processing.matrix import FeatureMatrix
+from finder.processing.similarity import calc_similarities, combine_similarity, rank_similarities, select_top_k
+from finder.utils.utils import FilePath
+
+_N_CENTROIDS: int = 256
+_MAX_TRAINING_SAMPLES: int = 64 * 1024
+
+
+def train_codebooks(
+        data: np.ndarray,
+        n_subspaces: int,
+        *,
+        n_iter: int = 20,
+        max_samples: int = 64 * 1024,
+        seed: Optional[int] = None
+) -> np.ndarray:
+    # One euclidean k-means codebook of 256 centroids per subspace, shaped (n_subspaces, 256, sub_dim)
+    subspaces = split_subspaces(data, n_subspaces)
+
+    return np.stack([
+        _pad_centroids(
+            kmeans(subspace, _N_CENTROIDS, spherical=False, n_iter=n_iter, max_samples=max_samples, seed=seed)
+        )
+        for subspace in subspaces
+    ])
+
+
+def split_subspaces(data: np.ndarray, n_subspaces: int) -> List[np.ndarray]:
+    # Vectors are zero padded so the dimension splits evenly across the subspaces
+    data = np.atleast_2d(np.asarray(data, dtype=np.float32))
+    sub_dim = math.ceil(data.shape[1] / n_subspaces)
+
+    padded = np.zeros((data.shape[0], sub_dim * n_subspaces), dtype=np.float32)
+    padded[:, :data.shape[1]] = data
+
+    return [padded[:, i * sub_dim:(i + 1) * sub_dim] for i in range(n_subspaces)]
+
+
+def _pad_centroids(centroids: np.ndarray) -> np.ndarray:
+    # Small training sets yield fewer than 256 centroids; the duplicated ones are simply never assigned
+    return np.resize(centroids, (_N_CENTROIDS, centroids.shape[1]))
+
+
+def _stack_vectors(vectors: Mapping[Path, np.ndarray], paths: List[Path]) -> np.ndarray:
+    if isinstance(vectors, FeatureMatrix):
+        return vectors.matrix[[vectors.row_of(path) for path in paths]]
+
+    return np.stack([np.asarray(vectors[path], dtype=np.float32).ravel() for path in paths])
+
+
+def _sample_vectors(vectors: Mapping[Path, np.ndarray], max_samples: int, seed: Optional[int] = None) -> np.ndarray:
+    # Only the sample is stacked, never the whole library
+    paths = list(vectors.keys())
+    if len(paths) > max_samples:
+        rows = np.sort(np.random.default_rng(seed).choice(len(paths), max_samples, replace=False))
+        paths = [paths[row] for row in rows]
+
+    return _stack_vectors(vectors, paths)
+
+
+class PQIndex(VectorIndex):
+    # Product quantization: every vector is stored as one byte per subspace plus its exact norm
+    # and squared quantization error, which removes the bias quantization adds to the euclidean distance.
+    # Queries are scored with asymmetric distance computation (the query itself is never quantized),
+    # and the best candidates can be re-ranked exactly with raw vectors read from disk on demand
+    # (the .npy cache or a memory-mapped feature store).
+
+    _MIN_CAPACITY: int = 1024
+
+    def __init__(
+            self,
+            vectors: Optional[Mapping[Path, np.ndarray]] = None,
+            *,
+            codebooks: np.ndarray | FilePath | None = None,
+            n_subspaces: int = 40,
+            raw_vectors: Optional[Mapping[Path, np.ndarray]] = None,
+            rerank: int = 100,
+            dim: Optional[int] = None,
+            seed: Optional[int] = None
+    ):
+        self.raw_vectors = raw_vectors
+        self.rerank = rerank
+        self.codebooks: Optional[np.ndarray] = None
+
+        self._codes: np.ndarray = np.empty((0, n_subspaces), dtype=np.uint8)
+        self._norms: np.ndarray = np.empty(0, dtype=np.float32)
+        self._errors: np.ndarray = np.empty(0, dtype=np.float32)
+        self._valid: np.ndarray = np.empty(0, dtype=bool)
+        self._row_paths: List[Optional[Path]] = []
+        self._rows: Dict[Path, int] = {}
+        self._size: int = 0
+
+        # Vectors added before any codebook exists are kept raw and searched exactly
+        self._pending: FeatureMatrix = FeatureMatrix()
+
+        codebooks_path = Path(codebooks) if isinstance(codebooks, (str, Path)) else None
+        if codebooks_path is not None:
+            codebooks = np.load(codebooks_path) if codebooks_path.exists() else None
+
+        # Codebooks trained on other features (e.g. another layer) must be rejected before anything is encoded
+        if isinstance(codebooks, np.ndarray) and dim is not None and \
+                codebooks.shape[2] != math.ceil(dim / codebooks.shape[0]):
+            raise ValueError(
+                f"The PQ codebooks{f' at {codebooks_path}' if codebooks_path else ''} do not fit {dim}-d features; "
+                f"train them again for the current features."
+            )
+
+        if isinstance(codebooks, np.ndarray):
+            self.codebooks = codebooks.astype(np.float32)
+
+        elif vectors:
+            sample = _sample_vectors(vectors, _MAX_TRAINING_SAMPLES, seed)
+            self.codebooks = train_codebooks(sample, n_subspaces, max_samples=_MAX_TRAINING_SAMPLES, seed=seed)
+
+            if codebooks_path is not None:
+                self.save(codebooks_path)
+
+        if vectors and self.trained:
+            self._load(vectors)
+
+        elif vectors:
+            self._pending.update(vectors)
+
+    @property
+    def trained(self) -> bool:
+        return self.codebooks is not None
+
+    def save(self, path: FilePath) -> None:
+        if not self.trained:
+            raise ValueError("Cannot save a PQ index that has not been trained.")
+
+        np.save(path, self.codebooks)
+
+    def __len__(self) -> int:
+        return len(self._rows) + len(self._pending)
+
+    def __contains__(self, path: object) -> bool:
+        return path in self._rows or path in self._pending
+
+    def add(self, path: Path, vector: np.ndarray) -> None:
+        if isinstance(self.raw_vectors, MutableMapping):
+            self.raw_vectors[path] = vector
+
+        if not self.trained:
+            self._pending[path] = vector
+            return
+
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+
+        row = self._rows.get(path)
+        if row is None:
+            self._reserve(self._size + 1)
+            row = self._size
+            self._size += 1
+            self._row_paths.append(path)
+            self._rows[path] = row
+            self._valid[row] = True
+
+        codes = self.encode(vector)
+        self._codes[row] = codes[0]
+        self._norms[row] = np.linalg.norm(vector)
+        self._errors[row] = self._quantization_errors(vector[None], codes)[0]
+
+    def remove(self, path: Path) -> None:
+        if isinstance(self.raw_vectors, MutableMapping) and path in self.raw_vectors:
+            del self.raw_vectors[path]
+
+        if path in self._pending:
+            del self._pending[path]
+            return
+
+        row = self._rows.pop(path)
+        self._row_paths[row] = None
+        self._valid[row] = False
+
+    def encode(self, data: np.ndarray) -> np.ndarray:
+        subspaces = split_subspaces(data, self.codebooks.shape[0])
+        return np.stack([
+            assign_clusters(subspace, codebook, spherical=False)
+            for subspace, codebook in zip(subspaces, self.codebooks)
+        ], axis=1).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray, dim: int) -> np.ndarray:
+        return np.concatenate([
+            codebook[codes[:, i]] for i, codebook in enumerate(self.codebooks)
+        ], axis=1)[:, :dim]
+
+    def search(
+            self,
+            reference_vector: np.ndarray,
+            *,
+            top_k: Optional[int] = None,
+            min_similarity: Optional[float] = 0.2,
+            max_similarity: Optional[float] = 0.9,
+            cosine_penalty_factor: float = 4,
+            euclidean_penalty_factor: float = 0.2,
+            rerank: Optional[int] = None,
+            **params
+    ) -> List[Tuple[FilePath, float]]:
+        thresholds = dict(min_similarity=min_similarity, max_similarity=max_similarity, top_k=top_k)
+        factors = dict(cosine_penalty_factor=cosine_penalty_factor, euclidean_penalty_factor=euclidean_penalty_factor)
+
+        if not self.trained:
+            return calc_similarities(reference_vector, self._pending, **thresholds, **factors)
+
+        if not self._size:
+            return []
+
+        similarities = self._approximate_similarities(reference_vector, **factors)
+        valid = self._valid[:self._size]
+
+        rerank = self.rerank if rerank is None else rerank
+        if not rerank or self.raw_vectors is None:
+            return rank_similarities(similarities, valid, self._path_at, **thresholds)
+
+        # Exact re-ranking of the best approximate candidates with their raw features
+        rows = select_top_k(similarities, np.flatnonzero(valid), max(rerank, top_k or 0))
+        candidates = {self._row_paths[row]: self.raw_vectors[self._row_paths[row]] for row in rows}
+        return calc_similarities(reference_vector, candidates, **thresholds, **factors)
+
+    def _approximate_similarities(
+            self,
+            reference_vector: np.ndarray,
+            cosine_penalty_factor: float,
+            euclidean_penalty_factor: float,
+            *,
+            chunk_size: int = 64 * 1024
+    ) -> np.ndarray:
+        reference_vector = np.asarray(reference_vector, dtype=np.float32).ravel()
+        subspaces = split_subspaces(reference_vector, self.codebooks.shape[0])
+
+        # Lookup tables of the query against every centroid of every subspace, flattened to (n_subspaces * 256)
+        dot_table = np.concatenate([codebook @ subspace[0] for subspace, codebook in zip(subspaces, self.codebooks)])
+        squared_table = np.concatenate([
+            ((codebook - subspace[0]) ** 2).sum(axis=1) for subspace, codebook in zip(subspaces, self.codebooks)
+        ])
+        offsets = np.arange(self.codebooks.shape[0]) * _N_CENTROIDS
+
+        dots = np.empty(self._size, dtype=np.float32)
+        squared_distances = np.empty(self._size, dtype=np.float32)
+        for start in range(0, self._size, chunk_size):
+            lookup = self._codes[start:min(start + chunk_size, self._size)] + offsets
+            dots[start:start + lookup.shape[0]] = dot_table[lookup].sum(axis=1)
+            squared_distances[start:start + lookup.shape[0]] = squared_table[lookup].sum(axis=1)
+
+        cosine_sim = dots / (self._norms[:self._size] * np.linalg.norm(reference_vector))
+        euclidean_distance = np.sqrt(np.maximum(squared_distances - self._errors[:self._size], 0))
+
+        return combine_similarity(cosine_sim, euclidean_distance, cosine_penalty_factor, euclidean_penalty_factor)
+
+    def _quantization_errors(self, data: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        return ((data - self.decode(codes, data.shape[1])) ** 2).sum(axis=1)
+
+    def _path_at(self, row: int) -> Path:
+        return self._row_paths[row]
+
+    def _load(self, vectors: Mapping[Path, np.ndarray], *, chunk_size: int = 64 * 1024) -> None:
+        # Encoded in chunks read straight from the source (e.g. a memory-mapped store or the .npy cache),
+        # so only one chunk of raw vectors is ever in memory
+        self._row_paths = list(vectors.keys())
+        self._rows = {path: row for row, path in enumerate(self._row_paths)}
+
+        size = len(self._row_paths)
+        self._codes = np.empty((size, self.codebooks.shape[0]), dtype=np.uint8)
+        self._norms = np.empty(size, dtype=np.float32)
+        self._errors = np.empty(size, dtype=np.float32)
+
+        for start in range(0, size, chunk_size):
+            data = _stack_vectors(vectors, self._row_paths[start:start + chunk_size])
+            end = start + data.shape[0]
+
+            self._codes[start:end] = self.encode(data)
+            self._norms[start:end] = np.linalg.norm(data, axis=1)
+            self._errors[start:end] = self._quantization_errors(data, self._codes[start:end])
+
+        self._valid = np.ones(size, dtype=bool)
+        self._size = size
+
+    def _reserve(self, size: int) -> None:
+        capacity = self._codes.shape[0]
+        if size <= capacity:
+            return
+
+        capacity = max(size, capacity * 2, self._MIN_CAPACITY)
+
+        codes = np.empty((capacity, self.codebooks.shape[0]), dtype=np.uint8)
+        codes[:self._size] = self._codes[:self._size]
+        norms = np.empty(capacity, dtype=np.float32)
+        norms[:self._size] = self._norms[:self._size]
+        errors = np.empty(capacity, dtype=np.float32)
+        errors[:self._size] = self._errors[:self._size]
+        valid = np.zeros(capacity, dtype=bool)
+        valid[:self._size] = self._valid[:self._size]
+
+        self._codes, self._norms, self._errors, self._valid = codes, norms, errors, valid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train PQ codebooks from the cached image features.")
+    parser.add_argument("cache_dir", type=Path, help="Directory containing the cached .npy features.")
+    parser.add_argument("output", type=Path, help="Where to save the trained codebooks (.npy).")
+    parser.add_argument("--n-subspaces", type=int, default=40, help="Number of subspaces, i.e. bytes per vector.")
+    parser.add_argument("--n-iter", type=int, default=20, help="Number of k-means iterations per subspace.")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    # Only a sample of the cache is read, as much as the k-means of each subspace uses
+    features = _sample_vectors(CachedFeatures(args.cache_dir), _MAX_TRAINING_SAMPLES, args.seed)
+    print(f"Training PQ codebooks on {features.shape[0]} vector(s)...")
+
+    trained = train_codebooks(features, args.n_subspaces, n_iter=args.n_iter, seed=args.seed)
+    np.save(args.output, trained)
+    print(f"Saved {trained.shape[0]} codebook(s) to {args.output}")
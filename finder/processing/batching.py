@@ -0,0 +1,129 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import Callable, List, Optional, Set, Tuple
+
+import numpy as np
+from PIL import Image
+
+_QueueItem = Tuple[Image.Image, asyncio.Future]
+
+
+class BatchingExtractor:
+    # Collects concurrent extraction requests for up to `max_wait` seconds (or until `max_batch_size`
+    # images are waiting), runs them through one batched forward pass and resolves every caller's
+    # future with its own row. While a batch is running, new requests queue up to form the next one;
+    # a bounded queue (`max_queue_size`) makes callers wait instead of piling up unbounded work.
+    # Up to `max_concurrent_batches` batches may run at once, e.g. one per inference worker process.
+
+    def __init__(
+            self,
+            batch_func: Callable[[List[Image.Image]], np.ndarray],
+            *,
+            max_batch_size: int = 16,
+            max_wait: float = 0.005,
+            max_queue_size: int = 0,
+            max_concurrent_batches: int = 1,
+            executor: Optional[Executor] = None
+    ):
+        self.batch_func = batch_func
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+        self.max_concurrent_batches = max(1, max_concurrent_batches)
+        self.executor = executor
+
+        self._queue: Optional[asyncio.Queue[_QueueItem]] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._batches: Set[asyncio.Task] = set()
+
+    async def extract(self, image: Image.Image) -> np.ndarray:
+        if self._worker is None:
+            self._queue = asyncio.Queue(self.max_queue_size)
+            self._start_worker()
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image, future))
+        return await future
+
+    def close(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+        for batch in self._batches:
+            batch.cancel()
+
+    def _start_worker(self) -> None:
+        self._worker = asyncio.create_task(self._run())
+        self._worker.add_done_callback(self._restart_worker)
+
+    def _restart_worker(self, worker: asyncio.Task) -> None:
+        # A worker that died on an unexpected error is replaced, otherwise queued callers would wait forever
+        if worker.cancelled() or worker is not self._worker:
+            return
+
+        print(f"The batching worker failed ({worker.exception()!r}), restarting it.")
+        self._start_worker()
+
+    async def _run(self) -> None:
+        slots = asyncio.Semaphore(self.max_concurrent_batches)
+
+        while True:
+            # A batch only starts forming once it can run, so waiting requests keep joining it meanwhile
+            await slots.acquire()
+
+            batch: List[_QueueItem] = []
+            try:
+                await self._collect(batch)
+            except Exception as e:
+                # Callers already taken from the queue are answered before the worker goes down
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                raise
+
+            # Callers that gave up (e.g. disconnected clients) do not need to be computed
+            batch = [(image, future) for image, future in batch if not future.done()]
+            if not batch:
+                slots.release()
+                continue
+
+            task = asyncio.create_task(self._run_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+    async def _collect(self, batch: List[_QueueItem]) -> None:
+        loop = asyncio.get_running_loop()
+
+        batch.append(await self._queue.get())
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    async def _run_batch(self, batch: List[_QueueItem]) -> None:
+        loop = asyncio.get_running_loop()
+
+        try:
+            features = await loop.run_in_executor(self.executor, self.batch_func, [image for image, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), row in zip(batch, features):
+            if not future.done():
+                future.set_result(row)
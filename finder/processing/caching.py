@@ -0,0 +1,117 @@
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Generic, Hashable, Optional, TypeVar
+
+import numpy as np
+
+from finder.utils.utils import FilePath
+
+_K = TypeVar("_K", bound=Hashable)
+_V = TypeVar("_V")
+
+
+class LRUCache(Generic[_K, _V]):
+    # Bounded mapping that evicts the least recently used entry, with hit/miss counters.
+    # Subclasses can back it with slower storage through `_load` and `_save`, which run outside the lock.
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[_K, _V] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._entries
+
+    def peek(self, key: _K) -> Optional[_V]:
+        return self._entries.get(key)
+
+    def get(self, key: _K) -> Optional[_V]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        value = self._load(key)
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._insert(key, value)
+            return value
+
+    def record_hit(self, key: _K) -> None:
+        # For entries looked up with `peek` that turned out to be usable, e.g. after revalidation
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+
+    def record_miss(self) -> None:
+        with self._lock:
+            self.misses += 1
+
+    def put(self, key: _K, value: _V) -> None:
+        with self._lock:
+            self._insert(key, value)
+
+        self._save(key, value)
+
+    def pop(self, key: _K) -> Optional[_V]:
+        with self._lock:
+            return self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "max_size": self.max_size}
+
+    def _insert(self, key: _K, value: _V) -> None:
+        if self.max_size <= 0:
+            return
+
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _load(self, key: _K) -> Optional[_V]:
+        return None
+
+    def _save(self, key: _K, value: _V) -> None:
+        pass
+
+
+class EmbeddingCache(LRUCache[str, np.ndarray]):
+    # Feature vectors keyed by a hash of the encoded image bytes, so the same image served from
+    # different URLs is only run through the model once. With a `directory`, every entry is also
+    # written as a .npy file and reloaded after eviction or a restart.
+
+    def __init__(self, max_size: int, directory: Optional[FilePath] = None):
+        super().__init__(max_size)
+        self.directory = Path(directory) if directory is not None else None
+
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _load(self, key: str) -> Optional[np.ndarray]:
+        if self.directory is None:
+            return None
+
+        try:
+            return np.load(self.directory / f"{key}.npy")
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _save(self, key: str, value: np.ndarray) -> None:
+        if self.directory is not None:
+            np.save(self.directory / f"{key}.npy", value)
@@ -1,32 +1,124 @@
-from typing import Self
+from typing import Self, Sequence, Tuple, Dict, Optional
 import numpy as np
 import torch
 from PIL import Image
+from torch import nn
 from torchvision.models import resnet50, ResNet50_Weights
 from torchvision import transforms
 
+from finder.backends.factory import BACKENDS, create_backend
+
+INPUT_SIZE: Tuple[int, int] = (256, 256)
+
+_TRANSFORM = transforms.Compose([
+    transforms.Resize(INPUT_SIZE),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+])
+
+
+def preprocess_images(images: Sequence[Image.Image]) -> torch.Tensor:
+    # Needs no model, so processes that only hand batches to inference workers can prepare them too
+    return torch.stack([_TRANSFORM(image) for image in images])
+
 
 class FeaturesExtractor:
     _PROCESSOR: Self | None = None
 
+    # Layers of resnet50 whose output can be used as features; "fc" gives the 1000 ImageNet logits,
+    # "avgpool" the 2048-d pooled embedding and earlier layers are globally average pooled as well
+    LAYERS: Tuple[str, ...] = ("layer1", "layer2", "layer3", "layer4", "avgpool", "fc")
+    LAYER_DIMS: Dict[str, int] = {
+        "layer1": 256, "layer2": 512, "layer3": 1024, "layer4": 2048, "avgpool": 2048, "fc": 1000
+    }
+
     def __new__(cls, *args, **kwargs):
         if cls._PROCESSOR is None:
             cls._PROCESSOR = super().__new__(cls)
 
         return cls._PROCESSOR
 
-    def __init__(self):
+    def __init__(
+            self,
+            layer: str = "fc",
+            backend: str = "torch",
+            *,
+            intra_op_threads: Optional[int] = None,
+            inter_op_threads: Optional[int] = None,
+            **backend_options
+    ):
         if not hasattr(self, 'initialized'):
+            if layer not in self.LAYERS:
+                raise ValueError(f"Unknown layer {layer!r}, expected one of {', '.join(self.LAYERS)}.")
+
+            # PyTorch sizes its thread pools once, before the first operation runs
+            if intra_op_threads:
+                torch.set_num_threads(intra_op_threads)
+            if inter_op_threads:
+                torch.set_num_interop_threads(inter_op_threads)
+
+            backend_cls = BACKENDS.get(backend.lower())
+            if intra_op_threads and backend_cls is not None and backend_cls.OWN_THREAD_POOL:
+                backend_options["intra_op_threads"] = intra_op_threads
+
+            self.layer = layer
+            self.backend_name = backend
             self._device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-            self._model = resnet50(weights=ResNet50_Weights.IMAGENET1K_V1).to(self._device).eval()
-            self._transform = transforms.Compose([
-                transforms.Resize((256, 256)),
-                transforms.ToTensor(),
-                transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-            ])
+            self._model = self._truncate(resnet50(weights=ResNet50_Weights.IMAGENET1K_V1), layer).eval()
+            self.backend = create_backend(
+                backend,
+                self._model,
+                version=self.version,
+                device=self._device,
+                preprocess=self.preprocess,
+                **backend_options
+            )
+            self.initialized = True
+
+    @property
+    def version(self) -> str:
+        return self.version_of(self.layer, self.backend_name)
+
+    @staticmethod
+    def version_of(layer: str, backend: str = "torch") -> str:
+        # Identifies the feature space, features of different versions must never be compared
+        backend_cls = BACKENDS.get(backend.lower())
+        suffix = backend_cls.VERSION_SUFFIX if backend_cls is not None else None
+        return f"resnet50-{layer}" + (f"-{suffix}" if suffix else "")
+
+    @property
+    def dim(self) -> int:
+        return self.LAYER_DIMS[self.layer]
+
+    @property
+    def model(self) -> nn.Module:
+        return self._model
+
+    @staticmethod
+    def _truncate(model: nn.Module, layer: str) -> nn.Module:
+        if layer == "fc":
+            return model
+
+        children = []
+        for name, module in model.named_children():
+            children.append(module)
+            if name == layer:
+                break
+
+        if layer != "avgpool":
+            children.append(nn.AdaptiveAvgPool2d(1))
+
+        return nn.Sequential(*children)
+
+    def warmup(self, passes: int, batch_sizes: Sequence[int] = (1,)) -> None:
+        self.backend.warmup(passes, batch_sizes)
+
+    def preprocess(self, images: Sequence[Image.Image]) -> torch.Tensor:
+        return preprocess_images(images)
 
     def extract_features(self, image: Image.Image) -> np.ndarray:
-        tensor = self._transform(image).unsqueeze(0).to(self._device)
-        with torch.no_grad():
-            return self._model(tensor).flatten().cpu().numpy()
+        return self.backend.run(self.preprocess([image])).flatten()
 
+    def extract_features_batch(self, images: Sequence[Image.Image]) -> np.ndarray:
+        # One forward pass over the whole batch, returning one row per image
+        return self.backend.run(self.preprocess(images))
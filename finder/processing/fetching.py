@@ -0,0 +1,108 @@
+import asyncio
+import importlib.util
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+
+from finder.utils.utils import content_hasher
+
+
+class ResponseTooLargeError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class FetchResult:
+    content: Optional[bytes]  # None when the server answered 304 Not Modified
+    content_hash: Optional[str] = None  # see finder.utils.utils.content_hasher
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    @property
+    def not_modified(self) -> bool:
+        return self.content is None
+
+
+class ImageFetcher:
+    # Downloads query images through one shared keep-alive connection pool. Each host gets at most
+    # `max_connections_per_host` concurrent downloads, and bodies are streamed so an oversized
+    # response is aborted as soon as it crosses `max_bytes` instead of being buffered entirely.
+
+    def __init__(
+            self,
+            *,
+            max_bytes: int = 20 * 1024 * 1024,
+            connect_timeout: float = 3.0,
+            read_timeout: float = 10.0,
+            max_connections: int = 100,
+            max_keepalive_connections: int = 20,
+            max_connections_per_host: int = 10,
+            http2: Optional[bool] = None
+    ):
+        self.max_bytes = max_bytes
+        self.max_connections_per_host = max_connections_per_host
+
+        # HTTP/2 needs the optional `h2` package, so it is only enabled when it is installed
+        if http2 is None:
+            http2 = importlib.util.find_spec("h2") is not None
+
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        self._host_users: Dict[str, int] = {}  # downloads holding or waiting for a slot of each host
+
+    async def fetch(self, url: str, *, etag: Optional[str] = None, last_modified: Optional[str] = None) -> FetchResult:
+        host = httpx.URL(url).host
+
+        # Conditional GET: a previously seen validator lets the server answer 304 without a body
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+
+        async with self._host_slot(host), self._client.stream("GET", url, headers=headers) as response:
+            if response.status_code == 304 and headers:
+                return FetchResult(None, None, etag, last_modified)
+
+            response.raise_for_status()
+
+            content_length = response.headers.get("Content-Length")
+            if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+                raise ResponseTooLargeError(f"The image is larger than the {self.max_bytes} bytes limit")
+
+            # The body is hashed as it arrives, so no extra pass over the bytes is needed afterwards
+            buffer = bytearray()
+            hasher = content_hasher()
+            async for chunk in response.aiter_bytes():
+                buffer += chunk
+                hasher.update(chunk)
+                if len(buffer) > self.max_bytes:
+                    raise ResponseTooLargeError(f"The image is larger than the {self.max_bytes} bytes limit")
+
+            return FetchResult(
+                bytes(buffer), hasher.hexdigest(), response.headers.get("ETag"), response.headers.get("Last-Modified")
+            )
+
+    @asynccontextmanager
+    async def _host_slot(self, host: str) -> AsyncIterator[None]:
+        slots = self._host_slots.setdefault(host, asyncio.Semaphore(self.max_connections_per_host))
+        self._host_users[host] = self._host_users.get(host, 0) + 1
+
+        try:
+            async with slots:
+                yield
+        finally:
+            # Hosts are chosen by the callers, so the semaphore is dropped as soon as nobody uses it anymore
+            self._host_users[host] -= 1
+            if not self._host_users[host]:
+                del self._host_users[host], self._host_slots[host]
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
@@ -1,18 +1,118 @@
 from io import BytesIO
 from pathlib import Path
-from typing import Optional, Callable, Dict
+from typing import Optional, Callable, Dict, Iterator, Mapping, List, Tuple, Sequence, BinaryIO, Union
 
 import numpy as np
 import requests
 from PIL import Image
 
+from finder.processing.matrix import FeatureMatrix
+from finder.processing.store import FeatureStore
 from finder.utils.utils import list_files, image_extensions, FilePath
 
+# Input size of FeaturesExtractor: images only need to be decoded at (or just above) this resolution
+DRAFT_SIZE: Tuple[int, int] = (256, 256)
 
-def load_image_from_url(url: str) -> Optional[Image.Image]:
+
+def open_image(file: Union[FilePath, BinaryIO], draft_size: Optional[Tuple[int, int]] = DRAFT_SIZE) -> Image.Image:
+    image = Image.open(file)
+
+    # JPEGs can be decoded directly at 1/2, 1/4 or 1/8 scale as long as the result stays larger than
+    # `draft_size`, which skips most of the decoding work for large photos (a no-op for other formats)
+    if draft_size is not None:
+        image.draft("RGB", draft_size)
+
+    return image.convert("RGB")
+
+
+def decode_version(draft_size: Optional[Tuple[int, int]] = DRAFT_SIZE) -> str:
+    # Draft decoding changes the pixels the model sees, so its features must not be mixed with full decodes
+    return "full" if draft_size is None else f"draft{draft_size[0]}x{draft_size[1]}"
+
+
+def load_image_from_url(url: str, draft_size: Optional[Tuple[int, int]] = DRAFT_SIZE) -> Optional[Image.Image]:
     response = requests.get(url)
     response.raise_for_status()
-    return Image.open(BytesIO(response.content)).convert("RGB")
+    return decode_image(response.content, draft_size)
+
+
+def decode_image(data: bytes, draft_size: Optional[Tuple[int, int]] = DRAFT_SIZE) -> Image.Image:
+    return open_image(BytesIO(data), draft_size)
+
+
+class CachedFeatures(Mapping[Path, np.ndarray]):
+    # Read-only view over the per-image .npy cache, loading each vector only when it is accessed.
+    # With `paths`, it iterates over these images instead of every cached file.
+
+    def __init__(self, cache_dir: FilePath, paths: Optional[Sequence[Path]] = None):
+        self.cache_dir = Path(cache_dir)
+        self.paths = list(paths) if paths is not None else None
+
+    def __getitem__(self, path: Path) -> np.ndarray:
+        file = self.cache_dir / f"{Path(path).name}.npy"
+        if not file.exists():
+            raise KeyError(path)
+
+        return np.load(file)
+
+    def __iter__(self) -> Iterator[Path]:
+        if self.paths is not None:
+            return iter(self.paths)
+
+        return (Path(file.stem) for file in list_files(self.cache_dir, "npy"))
+
+    def __len__(self) -> int:
+        if self.paths is not None:
+            return len(self.paths)
+
+        return len(list_files(self.cache_dir, "npy"))
+
+
+def load_cached_features(cache_dir: FilePath) -> np.ndarray:
+    return np.stack([np.load(file).ravel() for file in list_files(cache_dir, "npy")]).astype(np.float32)
+
+
+def load_image_features(
+        path: FilePath,
+        cache_dir: FilePath,
+        extract_func: Callable[[Image.Image], np.ndarray],
+        *,
+        cache_file: Optional[Path] = None,
+        save_cache: bool = True
+) -> np.ndarray:
+    if cache_file is not None:
+        # Load from cache if available
+        return np.load(cache_file)
+
+    # Extract features if cache does not exist
+    path = Path(path)
+    img = open_image(path)
+    feats: np.ndarray = extract_func(img)
+
+    if save_cache:
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        np.save(cache_dir/path.name, feats)
+
+    return feats
+
+
+def extract_in_batches(
+        paths: Sequence[Path],
+        extract_func: Callable[[Image.Image], np.ndarray],
+        batch_extract_func: Optional[Callable[[List[Image.Image]], np.ndarray]] = None,
+        batch_size: int = 32
+) -> Iterator[Tuple[Path, np.ndarray]]:
+    for start in range(0, len(paths), batch_size):
+        batch_paths = paths[start:start + batch_size]
+        batch_images = [open_image(path) for path in batch_paths]
+
+        if batch_extract_func is not None:
+            batch_features = batch_extract_func(batch_images)
+        else:
+            batch_features = [extract_func(img) for img in batch_images]
+
+        yield from zip(batch_paths, batch_features)
 
 
 def load_features(
@@ -21,32 +121,82 @@ def load_features(
         extract_func: Callable[[Image.Image], np.ndarray],
         *,
         save_cache: bool = True,
-        load_cache: bool = True
+        load_cache: bool = True,
+        batch_extract_func: Optional[Callable[[List[Image.Image]], np.ndarray]] = None,
+        batch_size: int = 32
 ) -> Dict[Path, np.ndarray]:
     images_dir = Path(images_dir)
     cache_dir = Path(cache_dir)
 
-    image_files = list_files(images_dir, image_extensions)
+    image_files = [Path(path) for path in list_files(images_dir, image_extensions)]
     cached_files = {file.stem: file for file in (list_files(cache_dir, "npy") if cache_dir.exists() else [])}
 
-    features: Dict[Path, np.ndarray] = {}
+    loaded: Dict[Path, np.ndarray] = {}
+    missing: List[Path] = []
 
     for path in image_files:
-        path = Path(path)
-
         if load_cache and path.name in cached_files:
             # Load from cache if available
-            feats: np.ndarray = np.load(cached_files[path.name])
-            features[path] = feats
-            continue
+            loaded[path] = np.load(cached_files[path.name])
+        else:
+            missing.append(path)
 
-        # Extract features if cache does not exist
-        img = Image.open(path).convert("RGB")
-        feats: np.ndarray = extract_func(img)
-        features[path] = feats
+    # Extract features if cache does not exist, several images per forward pass
+    for path, feats in extract_in_batches(missing, extract_func, batch_extract_func, batch_size):
+        loaded[path] = feats
 
         if save_cache:
             cache_dir.mkdir(parents=True, exist_ok=True)
             np.save(cache_dir/path.name, feats)
 
+    return {path: loaded[path] for path in image_files}
+
+
+def cache_features(
+        images_dir: FilePath,
+        cache_dir: FilePath,
+        extract_func: Callable[[Image.Image], np.ndarray],
+        *,
+        batch_extract_func: Optional[Callable[[List[Image.Image]], np.ndarray]] = None,
+        batch_size: int = 32
+) -> List[Path]:
+    # Like load_features, but only fills the .npy cache and returns the images: no vector is kept in memory
+    images_dir = Path(images_dir)
+    cache_dir = Path(cache_dir)
+
+    image_files = [Path(path) for path in list_files(images_dir, image_extensions)]
+    cached_names = {file.stem for file in (list_files(cache_dir, "npy") if cache_dir.exists() else [])}
+    missing = [path for path in image_files if path.name not in cached_names]
+
+    for path, feats in extract_in_batches(missing, extract_func, batch_extract_func, batch_size):
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        np.save(cache_dir/path.name, feats)
+
+    return image_files
+
+
+def load_store_features(
+        images_dir: FilePath,
+        store: FeatureStore,
+        extract_func: Callable[[Image.Image], np.ndarray],
+        *,
+        batch_extract_func: Optional[Callable[[List[Image.Image]], np.ndarray]] = None,
+        batch_size: int = 32
+) -> FeatureMatrix:
+    images_dir = Path(images_dir)
+
+    features = FeatureMatrix.open(store, images_dir)
+    image_files = list_files(images_dir, image_extensions)
+    existing = set(image_files)
+
+    # Forget images that were removed from the directory
+    for path in [path for path in features if path not in existing]:
+        del features[path]
+
+    # Extract features for images the store does not know about yet
+    missing = [path for path in image_files if path not in features]
+    for path, feats in extract_in_batches(missing, extract_func, batch_extract_func, batch_size):
+        features[path] = feats
+
+    features.flush()
     return features
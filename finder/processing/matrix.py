@@ -0,0 +1,230 @@
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Mapping, MutableMapping, Optional, TYPE_CHECKING
+
+import numpy as np
+
+from finder.utils.utils import FilePath
+
+if TYPE_CHECKING:
+    from finder.processing.store import FeatureStore
+
+
+# All vectors live as rows of one contiguous (N, D) float32 matrix with precomputed norms.
+# Rows are only appended; deleting a path leaves a tombstone so row order matches insertion order.
+# The matrix can also be backed by a FeatureStore, in which case rows live in its memory-mapped file.
+class FeatureMatrix(MutableMapping[Path, np.ndarray]):
+    _MIN_CAPACITY: int = 1024
+
+    def __init__(self, vectors: Optional[Mapping[Path, np.ndarray]] = None, *, dim: Optional[int] = None):
+        self._dim: Optional[int] = dim
+        self._matrix: np.ndarray = np.empty((0, dim or 0), dtype=np.float32)
+        self._norms: np.ndarray = np.empty(0, dtype=np.float32)
+        self._valid: np.ndarray = np.empty(0, dtype=bool)
+        self._row_paths: List[Optional[Path]] = []
+        self._rows: Dict[Path, int] = {}
+        self._size: int = 0
+        self._store: Optional["FeatureStore"] = None
+
+        if vectors:
+            self._load(vectors)
+
+    @classmethod
+    def open(cls, store: "FeatureStore", root: FilePath = ".") -> "FeatureMatrix":
+        features = cls(dim=store.dim)
+        features._store = store
+
+        root = Path(root)
+        names, norms = store.read_manifest()
+
+        features._row_paths = [root / name if name is not None else None for name in names]
+        features._rows = {path: row for row, path in enumerate(features._row_paths) if path is not None}
+        features._size = len(names)
+
+        if store.dim is not None:
+            capacity = max(features._size, cls._MIN_CAPACITY)
+            features._matrix = store.open_matrix(capacity)
+            features._norms = np.zeros(capacity, dtype=np.float32)
+            features._norms[:features._size] = norms
+            features._valid = np.zeros(capacity, dtype=bool)
+            features._valid[:features._size] = [path is not None for path in features._row_paths]
+
+        return features
+
+    @classmethod
+    def from_arrays(
+            cls,
+            paths: List[Path],
+            matrix: np.ndarray,
+            norms: Optional[np.ndarray] = None
+    ) -> "FeatureMatrix":
+        # Wraps existing rows without copying them, e.g. a read-only memory map shared between processes.
+        # The first write to read-only rows copies them into a private matrix (see _write_row).
+        features = cls(dim=matrix.shape[1])
+        features._matrix = matrix
+        features._norms = norms if norms is not None else np.linalg.norm(matrix, axis=1).astype(np.float32)
+        features._valid = np.ones(len(paths), dtype=bool)
+        features._row_paths = list(paths)
+        features._rows = {path: row for row, path in enumerate(features._row_paths)}
+        features._size = len(paths)
+
+        return features
+
+    @property
+    def dim(self) -> Optional[int]:
+        return self._dim
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._matrix[:self._size]
+
+    @property
+    def norms(self) -> np.ndarray:
+        return self._norms[:self._size]
+
+    @property
+    def valid(self) -> np.ndarray:
+        return self._valid[:self._size]
+
+    @property
+    def has_tombstones(self) -> bool:
+        return len(self._rows) != self._size
+
+    def path_at(self, row: int) -> Path:
+        path = self._row_paths[row]
+        if path is None:
+            raise KeyError(row)
+        return path
+
+    def row_of(self, path: Path) -> int:
+        return self._rows[path]
+
+    def __getitem__(self, path: Path) -> np.ndarray:
+        return self._matrix[self._rows[path]]
+
+    def __setitem__(self, path: Path, vector: np.ndarray) -> None:
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+
+        if self._dim is None:
+            self._dim = vector.shape[0]
+            self._matrix = np.empty((0, self._dim), dtype=np.float32)
+
+            if self._store is not None:
+                self._store.set_dim(self._dim)
+
+        if vector.shape[0] != self._dim:
+            raise ValueError(f"Expected a vector of dimension {self._dim}, got {vector.shape[0]}.")
+
+        if self._store is None:
+            self._write_row(path, vector)
+            return
+
+        # Other processes may append to the same store, so rows are allocated and recorded under its lock.
+        # The row is flushed before the manifest points to it.
+        with self._store.lock:
+            row = self._write_row(path, vector, self._store.next_row())
+            self._matrix.flush()
+            self._store.record(path.name, row, self._norms[row])
+
+    def __delitem__(self, path: Path) -> None:
+        row = self._rows.pop(path)
+        self._row_paths[row] = None
+        self._valid[row] = False
+
+        if self._store is not None:
+            # Rows of a store are never moved, the tombstone is journaled instead
+            with self._store.lock:
+                self._store.record_delete(path.name)
+
+        elif self._size - len(self._rows) > max(self._MIN_CAPACITY, self._size // 2):
+            self.compact()
+
+    def __iter__(self) -> Iterator[Path]:
+        return (path for path in self._row_paths if path is not None)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, path: object) -> bool:
+        return path in self._rows
+
+    def subset(self, paths: Iterable[Path]) -> "FeatureMatrix":
+        return FeatureMatrix({path: self[path] for path in paths}, dim=self._dim)
+
+    def flush(self) -> None:
+        if isinstance(self._matrix, np.memmap):
+            self._matrix.flush()
+
+    def compact(self) -> None:
+        if self._store is not None:
+            raise ValueError("A store backed feature matrix cannot be compacted in place.")
+
+        rows = np.flatnonzero(self.valid)
+
+        self._matrix = np.ascontiguousarray(self._matrix[rows])
+        self._norms = self._norms[rows]
+        self._valid = np.ones(rows.shape[0], dtype=bool)
+        self._row_paths = [self._row_paths[row] for row in rows]
+        self._rows = {path: row for row, path in enumerate(self._row_paths)}
+        self._size = rows.shape[0]
+
+    def _load(self, vectors: Mapping[Path, np.ndarray]) -> None:
+        # Fill the matrix at once instead of growing it one row at a time. Rows are copied one by one rather
+        # than stacked, so lazily loaded vectors (e.g. CachedFeatures) are never all in memory twice
+        self._row_paths = list(vectors.keys())
+        self._rows = {path: row for row, path in enumerate(self._row_paths)}
+
+        for row, vector in enumerate(vectors.values()):
+            vector = np.asarray(vector, dtype=np.float32).ravel()
+            if row == 0:
+                self._matrix = np.empty((len(self._row_paths), vector.shape[0]), dtype=np.float32)
+            self._matrix[row] = vector
+
+        self._norms = np.linalg.norm(self._matrix, axis=1)
+        self._valid = np.ones(len(self._row_paths), dtype=bool)
+        self._size = len(self._row_paths)
+        self._dim = self._matrix.shape[1]
+
+    def _write_row(self, path: Path, vector: np.ndarray, next_row: int = 0) -> int:
+        # Rows wrapped by from_arrays may be read-only, they are copied before the first write
+        if not self._matrix.flags.writeable:
+            self._matrix = np.array(self._matrix)
+        if not self._norms.flags.writeable:
+            self._norms = np.array(self._norms)
+
+        row = self._rows.get(path)
+        if row is None:
+            row = max(self._size, next_row)
+            self._reserve(row + 1)
+
+            # Rows in between were appended to the store by other processes, they are tombstones here
+            self._row_paths.extend([None] * (row - self._size))
+            self._row_paths.append(path)
+            self._size = row + 1
+            self._rows[path] = row
+            self._valid[row] = True
+
+        self._matrix[row] = vector
+        self._norms[row] = np.linalg.norm(vector)
+        return row
+
+    def _reserve(self, size: int) -> None:
+        capacity = self._matrix.shape[0]
+        if size <= capacity:
+            return
+
+        # Grow geometrically so that repeated appends stay amortized O(1)
+        capacity = max(size, capacity * 2, self._MIN_CAPACITY)
+
+        if self._store is not None:
+            # Growing the file and remapping it keeps the existing rows where they are
+            matrix = self._store.open_matrix(capacity)
+        else:
+            matrix = np.empty((capacity, self._dim), dtype=np.float32)
+            matrix[:self._size] = self._matrix[:self._size]
+
+        norms = np.empty(capacity, dtype=np.float32)
+        norms[:self._size] = self._norms[:self._size]
+        valid = np.zeros(capacity, dtype=bool)
+        valid[:self._size] = self._valid[:self._size]
+
+        self._matrix, self._norms, self._valid = matrix, norms, valid
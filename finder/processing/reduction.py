@@ -0,0 +1,157 @@
+import argparse
+import hashlib
+from pathlib import Path
+from typing import Callable, Optional, TypeVar
+
+import numpy as np
+
+from finder.processing.loading import load_cached_features
+from finder.processing.matrix import FeatureMatrix
+from finder.processing.store import FeatureStore
+from finder.utils.utils import FilePath
+
+METHODS = ("pca", "random")
+
+_I = TypeVar("_I")
+
+
+class Projection:
+    # Linear map from the extracted features to `dim` dimensions, applied both when images are ingested
+    # and to queries. PCA keeps the directions of largest variance of the library; a Gaussian random
+    # projection needs no training and preserves distances in expectation (Johnson-Lindenstrauss).
+
+    def __init__(
+            self,
+            components: np.ndarray,
+            method: str,
+            source: Optional[str] = None,
+            mean: Optional[np.ndarray] = None
+    ):
+        self.components = np.ascontiguousarray(components, dtype=np.float32)  # (input_dim, dim)
+        # Subtracted before projecting, PCA components are the directions of variance around the library mean
+        self.mean = np.zeros(self.input_dim, dtype=np.float32) if mean is None else np.asarray(mean, np.float32)
+        self.method = method
+        self.source = source  # version of the features it was fitted on (see FeaturesExtractor.version)
+
+    @property
+    def input_dim(self) -> int:
+        return self.components.shape[0]
+
+    @property
+    def dim(self) -> int:
+        return self.components.shape[1]
+
+    @property
+    def version(self) -> str:
+        # Refitting produces a different projection, so the fingerprint keeps their outputs apart
+        fingerprint = hashlib.blake2b(self.components.tobytes() + self.mean.tobytes(), digest_size=4).hexdigest()
+        return f"{self.method}{self.dim}-{fingerprint}"
+
+    def __call__(self, vectors: np.ndarray) -> np.ndarray:
+        # Works on a single vector as well as on a (N, input_dim) batch
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim > 1:
+            return (vectors.reshape(-1, self.input_dim) - self.mean) @ self.components
+
+        return (vectors.ravel() - self.mean) @ self.components
+
+    @classmethod
+    def fit(
+            cls,
+            data: np.ndarray,
+            dim: int,
+            method: str = "pca",
+            *,
+            source: Optional[str] = None,
+            max_samples: int = 100 * 1024,
+            seed: Optional[int] = None
+    ) -> "Projection":
+        if method not in METHODS:
+            raise ValueError(f"Unknown projection method {method!r}, expected one of {', '.join(METHODS)}.")
+
+        data = np.asarray(data, dtype=np.float32)
+        if method == "pca" and data.shape[0] < 2:
+            raise ValueError("At least two feature vectors are needed to fit a PCA projection.")
+
+        if dim > data.shape[1]:
+            raise ValueError(f"Cannot project {data.shape[1]}-d features to {dim} dimensions.")
+
+        rng = np.random.default_rng(seed)
+
+        if method == "random":
+            components = rng.normal(0, 1 / np.sqrt(dim), size=(data.shape[1], dim))
+            return cls(components, method, source)
+
+        if data.shape[0] > max_samples:
+            data = data[rng.choice(data.shape[0], max_samples, replace=False)]
+
+        # Eigenvectors of the covariance matrix, largest eigenvalues first
+        mean = data.mean(axis=0)
+        centered = data - mean
+        _, eigenvectors = np.linalg.eigh(centered.T @ centered)
+        return cls(eigenvectors[:, ::-1][:, :dim], method, source, mean)
+
+    @classmethod
+    def load(cls, path: FilePath, source: Optional[str] = None) -> "Projection":
+        with np.load(path) as saved:
+            projection = cls(
+                saved["components"],
+                str(saved["method"]),
+                str(saved["source"]) or None,
+                saved["mean"] if "mean" in saved else None
+            )
+
+        if source is not None and projection.source not in (None, source):
+            raise ValueError(f"The projection at {path} was fitted on {projection.source} features, not {source}.")
+
+        return projection
+
+    def save(self, path: FilePath) -> None:
+        with open(path, "wb") as file:
+            np.savez(file, components=self.components, mean=self.mean, method=self.method, source=self.source or "")
+
+
+def load_library_features(directory: FilePath) -> np.ndarray:
+    # Either a feature store or a directory of cached .npy features
+    directory = Path(directory)
+    if (directory / FeatureStore.META_FILE).exists():
+        features = FeatureMatrix.open(FeatureStore(directory))
+        return features.matrix[features.valid]
+
+    if not any(directory.glob("*.npy")):
+        return np.empty((0, 0), dtype=np.float32)
+
+    return load_cached_features(directory)
+
+
+def project_features(
+        extract_func: Callable[[_I], np.ndarray],
+        projection: Optional[Projection]
+) -> Callable[[_I], np.ndarray]:
+    if projection is None:
+        return extract_func
+
+    return lambda images: projection(extract_func(images))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit a dimensionality reduction from the cached image features.")
+    parser.add_argument("features_dir", type=Path, help="Feature store or directory of cached .npy features.")
+    parser.add_argument("output", type=Path, help="Where to save the projection (.npz).")
+    parser.add_argument("--dim", type=int, default=128, help="Number of dimensions to keep.")
+    parser.add_argument("--method", choices=METHODS, default="pca")
+    parser.add_argument(
+        "--source", default=None, help="Version of the cached features, e.g. resnet50-avgpool/draft256x256."
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    features = load_library_features(args.features_dir)
+    if args.method == "pca" and features.shape[0] < 2:
+        parser.exit(1, f"{args.features_dir} holds {features.shape[0]} feature vector(s), a PCA needs at least two.\n")
+
+    print(f"Fitting a {args.method} projection to {args.dim} dimensions on {features.shape[0]} vector(s)...")
+
+    fitted = Projection.fit(features, args.dim, args.method, source=args.source, seed=args.seed)
+    fitted.save(args.output)
+    print(f"Saved projection {fitted.version} to {args.output}")
@@ -0,0 +1,131 @@
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, Mapping, Optional
+
+import numpy as np
+
+from finder.processing.matrix import FeatureMatrix
+from finder.utils.concurrency import FileLock
+from finder.utils.utils import FilePath
+
+
+class SharedFeatures:
+    # Publishes the feature matrix of the library once, for every server process on the machine.
+    # A single loader process (elected with an exclusive file lock) writes each version of the matrix
+    # as a new numbered generation of .npy files, then atomically points CURRENT at it. The other
+    # processes memory-map the current generation read-only, so they all share the same physical
+    # pages: with the directory on a tmpfs such as /dev/shm, memory use stays constant as workers are added.
+    # Trained index structures (e.g. IVF centroids) may be published with a generation, so that readers
+    # building their index from it do not train them again.
+
+    CURRENT_FILE: str = "CURRENT"
+    LOCK_FILE: str = "loader.lock"
+    # The current generation and the previous one, which readers may still be attaching. Older ones are removed,
+    # readers still mapping them keep their pages
+    KEEP_GENERATIONS: int = 2
+
+    _GENERATION_FILE = re.compile(r"^(\d+)\.(features\.npy|norms\.npy|paths\.json|trained\.npz)$")
+
+    def __init__(self, directory: FilePath):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.current_path = self.directory / self.CURRENT_FILE
+        self._lock = FileLock(self.directory / self.LOCK_FILE)
+
+    @property
+    def is_loader(self) -> bool:
+        return self._lock.held
+
+    def try_become_loader(self) -> bool:
+        # The lock is released by the OS when the loader exits, so another process can take over
+        if not FileLock.INTERPROCESS:
+            raise OSError("Electing the loader process requires file locks (fcntl), unavailable on this platform.")
+
+        return self._lock.held or self._lock.acquire(blocking=False)
+
+    def current_generation(self) -> Optional[int]:
+        try:
+            return int(self.current_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @staticmethod
+    def snapshot(vectors: Mapping[Path, np.ndarray]) -> FeatureMatrix:
+        # Copy of the valid rows, much cheaper than writing them: the loader takes it while holding its index
+        # lock and publishes it once the lock is released
+        if not isinstance(vectors, FeatureMatrix):
+            return FeatureMatrix(vectors)
+
+        rows = np.flatnonzero(vectors.valid)
+        paths = [vectors.path_at(row) for row in rows]
+        return FeatureMatrix.from_arrays(paths, vectors.matrix[rows], vectors.norms[rows])
+
+    def publish(self, vectors: Mapping[Path, np.ndarray], trained: Optional[Mapping[str, np.ndarray]] = None) -> int:
+        if not self.is_loader:
+            raise RuntimeError("Only the loader process can publish features.")
+
+        generation = (self.current_generation() or 0) + 1
+
+        # Only image names are published, readers resolve them against their own images directory
+        if isinstance(vectors, FeatureMatrix):
+            rows = np.flatnonzero(vectors.valid)
+            names = [vectors.path_at(row).name for row in rows]
+            # Snapshots have no tombstones, their rows are written as they are
+            if rows.shape[0] == vectors.valid.shape[0]:
+                source, norms = vectors.matrix, vectors.norms
+            else:
+                source, norms = vectors.matrix[rows], vectors.norms[rows]
+        else:
+            names = [Path(path).name for path in vectors]
+            source = np.stack([np.asarray(vector, dtype=np.float32).ravel() for vector in vectors.values()]) \
+                if vectors else np.empty((0, 0), dtype=np.float32)
+            norms = np.linalg.norm(source, axis=1)
+
+        np.save(self._path(generation, "features.npy"), np.ascontiguousarray(source, dtype=np.float32))
+        np.save(self._path(generation, "norms.npy"), np.asarray(norms, dtype=np.float32))
+        self._path(generation, "paths.json").write_text(json.dumps(names))
+        if trained:
+            with open(self._path(generation, "trained.npz"), "wb") as file:
+                np.savez(file, **trained)
+
+        # Readers only ever see a complete generation: CURRENT is switched by a single rename
+        temp_path = self.current_path.with_suffix(".tmp")
+        temp_path.write_text(str(generation))
+        os.replace(temp_path, self.current_path)
+
+        self._remove_generations(before=generation - self.KEEP_GENERATIONS + 1)
+        return generation
+
+    def attach(self, generation: int, root: FilePath = ".") -> FeatureMatrix:
+        root = Path(root)
+        names = json.loads(self._path(generation, "paths.json").read_text())
+        matrix = np.load(self._path(generation, "features.npy"), mmap_mode="r")
+        norms = np.load(self._path(generation, "norms.npy"), mmap_mode="r")
+
+        if matrix.shape[0] == 0:
+            return FeatureMatrix()
+
+        return FeatureMatrix.from_arrays([root / name for name in names], matrix, norms)
+
+    def trained(self, generation: int) -> Dict[str, np.ndarray]:
+        try:
+            with np.load(self._path(generation, "trained.npz")) as saved:
+                return {name: saved[name] for name in saved.files}
+        except FileNotFoundError:
+            return {}
+
+    def close(self) -> None:
+        if self._lock.held:
+            self._lock.release()
+
+    def _path(self, generation: int, name: str) -> Path:
+        return self.directory / f"{generation}.{name}"
+
+    def _remove_generations(self, before: int) -> None:
+        for path in self.directory.iterdir():
+            match = self._GENERATION_FILE.match(path.name)
+            if match is not None and int(match.group(1)) < before:
+                path.unlink(missing_ok=True)
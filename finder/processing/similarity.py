@@ -1,11 +1,28 @@
 from pathlib import Path
-from typing import Dict, Tuple, Optional, List
+from typing import Tuple, Optional, List, Mapping, Callable, Dict
 
 import numpy as np
 
+from finder.processing.matrix import FeatureMatrix
 from finder.utils.utils import FilePath
 
 
+def combine_similarity(
+        cosine_sim: np.ndarray | float,
+        euclidean_distance: np.ndarray | float,
+        cosine_penalty_factor: float,
+        euclidean_penalty_factor: float
+) -> np.ndarray | float:
+    cosine_distance = 1 - cosine_sim
+
+    # Adjusted similarities
+    adjusted_cosine_similarity = np.exp(-cosine_penalty_factor * cosine_distance)
+    adjusted_euclidean_similarity = 1 / (1 + euclidean_penalty_factor * euclidean_distance)
+
+    # Combined similarity
+    return (adjusted_cosine_similarity + adjusted_euclidean_similarity) / 2
+
+
 def calc_similarity(
         vector1: np.ndarray,
         vector2: np.ndarray,
@@ -14,43 +31,138 @@ def calc_similarity(
 ) -> float:
     # Cosine similarity
     cosine_sim = np.dot(vector1, vector2) / (np.linalg.norm(vector1) * np.linalg.norm(vector2))
-    cosine_distance = 1 - cosine_sim
 
     # Euclidean distance
     euclidean_distance = np.linalg.norm(vector1 - vector2)
 
-    # Adjusted similarities
-    adjusted_cosine_similarity = np.exp(-cosine_penalty_factor * cosine_distance)
-    adjusted_euclidean_similarity = 1 / (1 + euclidean_penalty_factor * euclidean_distance)
+    return combine_similarity(cosine_sim, euclidean_distance, cosine_penalty_factor, euclidean_penalty_factor)
 
-    # Combined similarity
-    combined_similarity = (adjusted_cosine_similarity + adjusted_euclidean_similarity) / 2
 
-    return combined_similarity
+def calc_batch_similarity(
+        reference_vector: np.ndarray,
+        matrix: np.ndarray,
+        norms: np.ndarray,
+        cosine_penalty_factor: float = 4,
+        euclidean_penalty_factor: float = 0.1,
+        *,
+        chunk_size: int = 4096
+) -> np.ndarray:
+    reference_vector = np.asarray(reference_vector, dtype=np.float32).ravel()
+
+    # Cosine similarity for every row in a single matrix-vector product
+    cosine_sim = (matrix @ reference_vector) / (norms * np.linalg.norm(reference_vector))
+
+    # Euclidean distance computed over row blocks, so the temporary difference stays cache sized
+    # while matching the per-pair `norm(vector1 - vector2)` exactly
+    euclidean_distance = np.empty(matrix.shape[0], dtype=np.float32)
+    for start in range(0, matrix.shape[0], chunk_size):
+        block = matrix[start:start + chunk_size]
+        euclidean_distance[start:start + block.shape[0]] = np.linalg.norm(block - reference_vector, axis=1)
+
+    return combine_similarity(cosine_sim, euclidean_distance, cosine_penalty_factor, euclidean_penalty_factor)
+
+
+def select_top_k(similarities: np.ndarray, rows: np.ndarray, top_k: Optional[int] = None) -> np.ndarray:
+    if top_k is not None and top_k <= 0:
+        return rows[:0]
+
+    if top_k is not None and top_k < rows.size:
+        # Partial selection: only the k best rows are ordered, so the cost grows with k instead of N log N
+        best = np.argpartition(-similarities[rows], top_k - 1)[:top_k]
+        rows = np.sort(rows[best])
+
+    return rows[np.argsort(-similarities[rows], kind="stable")]
 
 
 def calc_similarities(
         reference_vector: np.ndarray,
-        vectors: Dict[Path, np.ndarray],
+        vectors: Mapping[Path, np.ndarray] | FeatureMatrix,
         *,
         min_similarity: Optional[float] = 0.2,
         max_similarity: Optional[float] = 0.9,
+        top_k: Optional[int] = None,
         cosine_penalty_factor: float = 4,
         euclidean_penalty_factor: float = 0.2
 ) -> List[Tuple[FilePath, float]]:
-    comparison_results = []
-
-    for path, vector in vectors.items():
-        similarity = calc_similarity(reference_vector, vector, cosine_penalty_factor, euclidean_penalty_factor)
+    if not isinstance(vectors, FeatureMatrix):
+        vectors = FeatureMatrix(vectors)
+
+    if not len(vectors):
+        return []
+
+    similarities = calc_batch_similarity(
+        reference_vector, vectors.matrix, vectors.norms, cosine_penalty_factor, euclidean_penalty_factor
+    )
+
+    return rank_similarities(
+        similarities,
+        vectors.valid,
+        vectors.path_at,
+        min_similarity=min_similarity,
+        max_similarity=max_similarity,
+        top_k=top_k
+    )
+
+
+def rank_similarities(
+        similarities: np.ndarray,
+        valid: np.ndarray,
+        path_at: Callable[[int], FilePath],
+        *,
+        min_similarity: Optional[float] = 0.2,
+        max_similarity: Optional[float] = 0.9,
+        top_k: Optional[int] = None
+) -> List[Tuple[FilePath, float]]:
+    mask = valid.copy()
+    if min_similarity:
+        mask &= similarities >= min_similarity
 
-        if min_similarity and similarity < min_similarity:
-            continue
+    if max_similarity:
+        # Same short-circuit as a sequential scan: the first row reaching the threshold wins
+        exact_rows = np.flatnonzero(mask & (similarities >= max_similarity))
+        if exact_rows.size:
+            row = exact_rows[0]
+            return [(path_at(row), float(similarities[row]))]
 
-        if max_similarity and similarity >= max_similarity:
-            return [(path, similarity)]
+    rows = np.flatnonzero(mask)
+    rows = select_top_k(similarities, rows, top_k)
 
-        comparison_results.append((path, similarity))
+    return [(path_at(row), float(similarities[row])) for row in rows]
 
-    comparison_results.sort(key=lambda x: x[1], reverse=True)
 
-    return comparison_results
+def compare_features(
+        expected: np.ndarray,
+        actual: np.ndarray,
+        *,
+        cosine_penalty_factor: float = 4,
+        euclidean_penalty_factor: float = 0.2
+) -> Dict[str, float]:
+    # Measures how far approximate features (another backend, quantization...) are from reference ones
+    # computed on the same images. Besides raw output differences, what matters is how much the pairwise
+    # similarities used for ranking move, and whether each image keeps the same nearest neighbour.
+    # The penalty factors default to the ones searches use (see calc_similarities), so the drift is measured
+    # on the similarities that are actually served.
+    expected_norms = np.linalg.norm(expected, axis=1)
+    actual_norms = np.linalg.norm(actual, axis=1)
+    factors = (cosine_penalty_factor, euclidean_penalty_factor)
+
+    expected_similarities = np.stack([
+        calc_batch_similarity(row, expected, expected_norms, *factors) for row in expected
+    ])
+    actual_similarities = np.stack([calc_batch_similarity(row, actual, actual_norms, *factors) for row in actual])
+    drift = np.abs(actual_similarities - expected_similarities)[~np.eye(len(expected), dtype=bool)]
+
+    # An image is always its own nearest neighbour, so the diagonal is excluded
+    np.fill_diagonal(expected_similarities, -np.inf)
+    np.fill_diagonal(actual_similarities, -np.inf)
+    difference = np.abs(actual - expected)
+    cosine = (expected * actual).sum(axis=1) / np.maximum(expected_norms * actual_norms, 1e-12)
+
+    return {
+        "max_abs_diff": float(difference.max()),
+        "max_rel_diff": float((difference.max(axis=1) / np.maximum(np.abs(expected).max(axis=1), 1e-12)).max()),
+        "min_cosine": float(cosine.min()),
+        "max_similarity_drift": float(drift.max()),
+        "mean_similarity_drift": float(drift.mean()),
+        "top1_agreement": float(np.mean(expected_similarities.argmax(axis=1) == actual_similarities.argmax(axis=1))),
+    }
@@ -0,0 +1,179 @@
+import argparse
+import json
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, TextIO
+
+import numpy as np
+
+from finder.processing.matrix import FeatureMatrix
+from finder.utils.concurrency import FileLock
+from finder.utils.utils import FilePath, list_files
+
+
+class FeatureStore:
+    # A single append-only float32 matrix file plus a JSON lines manifest mapping rows to image names.
+    # The matrix is opened with np.memmap, so startup reads no feature data and the OS page cache
+    # is shared between every process using the same store. Rows are allocated under a file lock,
+    # so several processes can append to the same store.
+
+    DATA_FILE: str = "features.f32"
+    MANIFEST_FILE: str = "manifest.jsonl"
+    META_FILE: str = "meta.json"
+    LOCK_FILE: str = "store.lock"
+
+    def __init__(self, directory: FilePath, dim: Optional[int] = None, *, version: Optional[str] = None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.data_path = self.directory / self.DATA_FILE
+        self.manifest_path = self.directory / self.MANIFEST_FILE
+        self.meta_path = self.directory / self.META_FILE
+
+        self.lock = FileLock(self.directory / self.LOCK_FILE)
+
+        self._manifest: Optional[TextIO] = None
+        self._manifest_offset = 0  # how much of the manifest has been read
+        self._next_row = 0
+
+        # `version` identifies the feature space (see FeaturesExtractor.version); stores written before
+        # versioning have none and adopt the first version they are opened with
+        self.dim: Optional[int] = None
+        self.version = version
+        if self.meta_path.exists():
+            meta = json.loads(self.meta_path.read_text())
+            self.dim = meta["dim"]
+
+            if version is not None and meta.get("version", version) != version:
+                raise ValueError(f"The feature store holds {meta['version']} features, expected {version}.")
+
+            if version is not None and "version" not in meta:
+                self._write_meta()
+        elif dim is not None:
+            self.set_dim(dim)
+
+    def set_dim(self, dim: int) -> None:
+        if self.dim is not None and self.dim != dim:
+            raise ValueError(f"The feature store holds vectors of dimension {self.dim}, got {dim}.")
+
+        if self.dim is None:
+            self.dim = dim
+            self._write_meta()
+
+    def read_manifest(self) -> Tuple[List[Optional[str]], np.ndarray]:
+        # Replays the manifest: rows whose name was later deleted or written again become tombstones (None)
+        names: List[Optional[str]] = []
+        norms: List[float] = []
+        rows: Dict[str, int] = {}
+
+        self._manifest_offset = 0
+        for record in self._read_records():
+            name = record["name"]
+
+            if name in rows:
+                names[rows.pop(name)] = None
+
+            if record.get("deleted"):
+                continue
+
+            row = record["row"]
+            if row >= len(names):
+                names.extend([None] * (row + 1 - len(names)))
+                norms.extend([0.0] * (row + 1 - len(norms)))
+
+            names[row] = name
+            norms[row] = record["norm"]
+            rows[name] = row
+
+        self._next_row = max(self._next_row, len(names))
+        return names, np.asarray(norms, dtype=np.float32)
+
+    def next_row(self) -> int:
+        # First row nobody has allocated yet, including other processes appending to the same store.
+        # Must be called while holding `lock`, until the row is recorded.
+        for record in self._read_records():
+            if "row" in record:
+                self._next_row = max(self._next_row, record["row"] + 1)
+
+        return self._next_row
+
+    def open_matrix(self, capacity: int, *, writable: bool = True) -> np.memmap:
+        if self.dim is None:
+            raise ValueError("Cannot open the feature matrix before its dimension is known.")
+
+        # The file is grown ahead of time (sparsely) so appends only write into the existing mapping
+        size = capacity * self.dim * np.dtype(np.float32).itemsize
+        if writable and (not self.data_path.exists() or self.data_path.stat().st_size < size):
+            with open(self.data_path, "ab") as data:
+                data.truncate(size)
+
+        return np.memmap(self.data_path, dtype=np.float32, mode="r+" if writable else "r", shape=(capacity, self.dim))
+
+    def record(self, name: str, row: int, norm: float) -> None:
+        self._append_manifest({"name": name, "row": row, "norm": float(norm)})
+        self._next_row = max(self._next_row, row + 1)
+
+    def record_delete(self, name: str) -> None:
+        self._append_manifest({"name": name, "deleted": True})
+
+    def close(self) -> None:
+        if self._manifest is not None:
+            self._manifest.close()
+            self._manifest = None
+
+    def _write_meta(self) -> None:
+        meta = {"dim": self.dim}
+        if self.version is not None:
+            meta["version"] = self.version
+
+        self.meta_path.write_text(json.dumps(meta))
+
+    def _read_records(self) -> Iterator[Dict]:
+        # Reads the records appended since the previous call, a partially written last line is left for later
+        if not self.manifest_path.exists():
+            return
+
+        with open(self.manifest_path, "rb") as manifest:
+            manifest.seek(self._manifest_offset)
+            data = manifest.read()
+
+        end = data.rfind(b"\n") + 1
+        self._manifest_offset += end
+
+        for line in data[:end].decode("utf-8").splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+    def _append_manifest(self, record: Dict) -> None:
+        if self._manifest is None:
+            self._manifest = open(self.manifest_path, "a", encoding="utf-8")
+
+        self._manifest.write(json.dumps(record) + "\n")
+        self._manifest.flush()
+
+
+def migrate_cache(cache_dir: FilePath, store: FeatureStore) -> int:
+    features = FeatureMatrix.open(store)
+    migrated = 0
+
+    for file in list_files(cache_dir, "npy"):
+        path = Path(file.stem)
+        if path in features:
+            continue
+
+        features[path] = np.load(file)
+        migrated += 1
+
+    features.flush()
+    store.close()
+    return migrated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate the per-image .npy feature cache into a feature store.")
+    parser.add_argument("cache_dir", type=Path, help="Directory containing the cached .npy features.")
+    parser.add_argument("store_dir", type=Path, help="Directory of the consolidated feature store.")
+    args = parser.parse_args()
+
+    print(f"Migrating {args.cache_dir} into {args.store_dir}...")
+    count = migrate_cache(args.cache_dir, FeatureStore(args.store_dir))
+    print(f"{count} feature vector(s) migrated!")
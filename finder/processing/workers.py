@@ -0,0 +1,584 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import threading
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Client, Connection, Listener
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from finder.backends.factory import BACKENDS
+from finder.processing.features import INPUT_SIZE, FeaturesExtractor, preprocess_images
+from finder.utils.threads import available_cores, pin_current_thread
+from finder.utils.utils import image_extensions, list_files
+
+
+class WorkerExitedError(RuntimeError):
+    pass
+
+
+class InferencePool:
+    # Runs the model in `n_workers` dedicated processes, each with its own FeaturesExtractor. Every worker
+    # owns two shared memory blocks: the caller writes a preprocessed batch into the input block and the
+    # worker writes the features into the output block, so only small control messages go through the
+    # pipes and no array is ever pickled.
+    # Calls are thread safe: each one borrows an idle worker for the duration of a batch. A worker that
+    # exits fails its batch and is restarted; once none can be restarted, every call fails.
+    # The pool belongs to the process that creates it: to share one pool between the uvicorn workers of a
+    # machine, serve it with InferenceServer and connect to it with InferenceClient.
+
+    def __init__(
+            self,
+            n_workers: int,
+            layer: str = "fc",
+            backend: str = "torch",
+            *,
+            max_batch_size: int = 32,
+            worker_cores: Optional[Sequence[Sequence[int]]] = None,
+            **extractor_options
+    ):
+        if layer not in FeaturesExtractor.LAYERS:
+            raise ValueError(f"Unknown layer {layer!r}, expected one of {', '.join(FeaturesExtractor.LAYERS)}.")
+
+        self.layer = layer
+        self.backend_name = backend
+        self.max_batch_size = max_batch_size
+        self._input_shape = (max_batch_size, 3, *INPUT_SIZE)
+        self._output_shape = (max_batch_size, self.dim)
+
+        # Workers are spawned rather than forked: forking a process whose threads hold locks (PyTorch, the
+        # event loop) is unsafe, and spawned workers do not inherit the memory of the API process
+        context = multiprocessing.get_context("spawn")
+        self._workers: List[_Worker] = []
+        self._workers_lock = threading.Lock()
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+
+        try:
+            for i in range(n_workers):
+                cores = worker_cores[i] if worker_cores else ()
+                self._workers.append(
+                    _Worker(context, self._input_shape, self._output_shape, (layer, backend), extractor_options, cores)
+                )
+
+            # Every worker loads its model in parallel, then reports that it is ready (or why it failed)
+            for worker in self._workers:
+                worker.wait_ready()
+                self._idle.put(worker)
+        except BaseException:
+            # Workers already started and their shared memory would otherwise outlive the failed pool
+            self.close()
+            raise
+
+    @property
+    def version(self) -> str:
+        return FeaturesExtractor.version_of(self.layer, self.backend_name)
+
+    @property
+    def dim(self) -> int:
+        return FeaturesExtractor.LAYER_DIMS[self.layer]
+
+    @property
+    def concurrency(self) -> int:
+        # How many batches may run at once
+        return len(self._workers)
+
+    def warmup(self, passes: int, batch_sizes: Sequence[int] = (1,)) -> None:
+        # Every worker is borrowed first, so warmup messages never interleave with a batch on a worker's pipe
+        workers = [self._borrow() for _ in range(self.concurrency)]
+        try:
+            for i, worker in enumerate(workers):
+                try:
+                    worker.request(("warmup", passes, list(batch_sizes)))
+                except WorkerExitedError:
+                    workers[i] = self._replace(worker)
+                    raise
+        finally:
+            for worker in workers:
+                if worker is not None:
+                    self._idle.put(worker)
+
+    def extract_features(self, image: Image.Image) -> np.ndarray:
+        return self.extract_features_batch([image])[0]
+
+    def extract_features_batch(self, images: Sequence[Image.Image]) -> np.ndarray:
+        # One forward pass per `max_batch_size` images, returning one row per image
+        features = np.empty((len(images), self.dim), dtype=np.float32)
+
+        for start in range(0, len(images), self.max_batch_size):
+            batch = preprocess_images(images[start:start + self.max_batch_size]).numpy()
+            features[start:start + len(batch)] = self.run(batch)
+
+        return features
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        # Features of a preprocessed batch of at most `max_batch_size` images
+        worker = self._borrow()
+        try:
+            return worker.run(batch)
+        except WorkerExitedError:
+            worker = self._replace(worker)
+            raise
+        finally:
+            if worker is not None:
+                self._idle.put(worker)
+
+    def close(self) -> None:
+        with self._workers_lock:
+            workers, self._workers = self._workers, []
+
+        for worker in workers:
+            worker.close()
+
+    def _borrow(self) -> "_Worker":
+        while True:
+            try:
+                return self._idle.get(timeout=1)
+            except queue.Empty:
+                if not self._workers:
+                    raise RuntimeError("No inference worker is left: they exited and could not be restarted.")
+
+    def _replace(self, dead: "_Worker") -> Optional["_Worker"]:
+        # Returns the worker started in place of `dead`, or None when it could not be started
+        with self._workers_lock:
+            self._workers.remove(dead)
+        dead.close()
+
+        worker = None
+        try:
+            worker = dead.respawn()
+            worker.wait_ready()
+        except Exception as e:
+            print(f"Could not restart the inference worker ({e!r}), {len(self._workers)} worker(s) left.")
+            if worker is not None:
+                worker.close()
+            return None
+
+        with self._workers_lock:
+            self._workers.append(worker)
+        print(f"Restarted the inference worker {dead.pid} as {worker.pid}.")
+        return worker
+
+
+class InferenceServer:
+    # Serves an InferencePool on a Unix socket, so that every uvicorn worker of the machine shares the same
+    # model processes (see InferenceClient) instead of each one starting its own. Each client connection
+    # gets a pair of shared memory blocks: the client writes preprocessed batches into the first one and
+    # reads the features from the second, the server copies them to and from the pool workers.
+
+    def __init__(self, pool: InferencePool, address: str, *, authkey: Optional[bytes] = None):
+        self.pool = pool
+        self.address = address
+        self.authkey = authkey
+        self._listener: Optional[Listener] = None
+
+    def serve_forever(self) -> None:
+        # A socket left behind by a server that was killed would make the address unavailable
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+        self._listener = Listener(self.address, "AF_UNIX", authkey=self.authkey)
+        print(f"Serving {self.pool.version} ({self.pool.concurrency} worker(s)) on {self.address}.")
+
+        while True:
+            try:
+                connection = self._listener.accept()
+            except multiprocessing.AuthenticationError as e:
+                print(f"Rejected an inference client: {e}")
+                continue
+            except OSError:
+                return  # closed
+
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def close(self) -> None:
+        if self._listener is not None:
+            self._listener.close()
+        self.pool.close()
+
+    def _serve(self, connection: Connection) -> None:
+        input_shape = (self.pool.max_batch_size, 3, *INPUT_SIZE)
+        output_shape = (self.pool.max_batch_size, self.pool.dim)
+        inputs_memory = SharedMemory(create=True, size=int(np.prod(input_shape)) * 4)
+        outputs_memory = SharedMemory(create=True, size=int(np.prod(output_shape)) * 4)
+        inputs = np.ndarray(input_shape, dtype=np.float32, buffer=inputs_memory.buf)
+        outputs = np.ndarray(output_shape, dtype=np.float32, buffer=outputs_memory.buf)
+        unlinked = False
+
+        try:
+            connection.send({
+                "layer": self.pool.layer,
+                "backend": self.pool.backend_name,
+                "max_batch_size": self.pool.max_batch_size,
+                "concurrency": self.pool.concurrency,
+                "inputs": inputs_memory.name,
+                "outputs": outputs_memory.name
+            })
+
+            # Once both processes map the blocks, their names are no longer needed: the memory is freed with
+            # the last mapping, even if either process is killed
+            if connection.recv() != "attached":
+                return
+            for memory in (inputs_memory, outputs_memory):
+                memory.unlink()
+            unlinked = True
+
+            while (message := connection.recv()) is not None:
+                try:
+                    # Clients only run batches, the server warms the pool up before serving them
+                    size = message[1]
+                    outputs[:size] = self.pool.run(inputs[:size])
+                    connection.send(None)
+                except Exception as e:
+                    connection.send(e)
+        except (EOFError, OSError):
+            pass
+        finally:
+            del inputs, outputs
+            connection.close()
+            for memory in (inputs_memory, outputs_memory):
+                memory.close()
+                if not unlinked:
+                    memory.unlink()
+
+
+class InferenceClient:
+    # Same interface as InferencePool, for a pool served by InferenceServer in another process. The layer,
+    # backend and batch size are the server's. One batch runs per connection at a time, and by default there
+    # are as many connections as server workers. A connection lost with the server fails its batch and is
+    # opened again by the next one.
+
+    def __init__(self, address: str, *, authkey: Optional[bytes] = None, connections: Optional[int] = None):
+        first = _ServerConnection(address, authkey)
+        self.address = address
+        self.layer: str = first.info["layer"]
+        self.backend_name: str = first.info["backend"]
+        self.max_batch_size: int = first.info["max_batch_size"]
+
+        self._connections = [first]
+        self._idle: "queue.Queue[_ServerConnection]" = queue.Queue()
+        try:
+            for _ in range((connections or first.info["concurrency"]) - 1):
+                self._connections.append(_ServerConnection(address, authkey))
+        except BaseException:
+            self.close()
+            raise
+
+        for connection in self._connections:
+            self._idle.put(connection)
+
+    @property
+    def version(self) -> str:
+        return FeaturesExtractor.version_of(self.layer, self.backend_name)
+
+    @property
+    def dim(self) -> int:
+        return FeaturesExtractor.LAYER_DIMS[self.layer]
+
+    @property
+    def concurrency(self) -> int:
+        return len(self._connections)
+
+    def warmup(self, passes: int, batch_sizes: Sequence[int] = (1,)) -> None:
+        # The server warms its workers up once when it starts, clients do not repeat it
+        pass
+
+    def extract_features(self, image: Image.Image) -> np.ndarray:
+        return self.extract_features_batch([image])[0]
+
+    def extract_features_batch(self, images: Sequence[Image.Image]) -> np.ndarray:
+        features = np.empty((len(images), self.dim), dtype=np.float32)
+
+        for start in range(0, len(images), self.max_batch_size):
+            batch = preprocess_images(images[start:start + self.max_batch_size]).numpy()
+
+            connection = self._idle.get()
+            try:
+                features[start:start + len(batch)] = connection.run(batch)
+            finally:
+                self._idle.put(connection)
+
+        return features
+
+    def close(self) -> None:
+        for connection in self._connections:
+            connection.close()
+
+
+class _ServerConnection:
+    def __init__(self, address: str, authkey: Optional[bytes]):
+        self.address = address
+        self.authkey = authkey
+        self.info: Dict[str, Any] = {}
+        self._connection: Optional[Connection] = None
+        self._connect()
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        if self._connection is None:
+            self._connect()
+
+        size = len(batch)
+        try:
+            self.inputs[:size] = batch
+            self._connection.send(("run", size))
+            reply = self._connection.recv()
+        except (EOFError, OSError) as e:
+            self.close()
+            raise RuntimeError(f"Lost the connection to the inference server at {self.address}: {e!r}")
+
+        if isinstance(reply, BaseException):
+            raise reply
+
+        return self.outputs[:size].copy()
+
+    def close(self) -> None:
+        if self._connection is None:
+            return
+
+        try:
+            self._connection.send(None)
+        except OSError:
+            pass
+
+        self._connection.close()
+        self._connection = None
+
+        del self.inputs, self.outputs
+        for memory in (self._inputs_memory, self._outputs_memory):
+            memory.close()
+
+    def _connect(self) -> None:
+        try:
+            connection = Client(self.address, "AF_UNIX", authkey=self.authkey)
+            info = connection.recv()
+        except (EOFError, OSError) as e:
+            raise RuntimeError(f"Could not connect to the inference server at {self.address}: {e!r}")
+
+        # A server restarted with another model must not be mixed with the features already extracted
+        described = {key: info[key] for key in ("layer", "backend")}
+        if self.info and described != {key: self.info[key] for key in ("layer", "backend")}:
+            connection.close()
+            raise RuntimeError(f"The inference server at {self.address} now runs {described}.")
+
+        self.info = info
+        self._inputs_memory = _attach_memory(info["inputs"])
+        self._outputs_memory = _attach_memory(info["outputs"])
+        input_shape = (info["max_batch_size"], 3, *INPUT_SIZE)
+        output_shape = (info["max_batch_size"], FeaturesExtractor.LAYER_DIMS[info["layer"]])
+        self.inputs = np.ndarray(input_shape, dtype=np.float32, buffer=self._inputs_memory.buf)
+        self.outputs = np.ndarray(output_shape, dtype=np.float32, buffer=self._outputs_memory.buf)
+        self._connection = connection
+        self._connection.send("attached")
+
+
+class _Worker:
+    def __init__(
+            self,
+            context: Any,
+            input_shape: Tuple[int, ...],
+            output_shape: Tuple[int, ...],
+            extractor_args: Tuple,
+            extractor_options: Dict[str, Any],
+            cores: Sequence[int]
+    ):
+        self._args = (context, input_shape, output_shape, extractor_args, extractor_options, cores)
+        self._inputs_memory = SharedMemory(create=True, size=int(np.prod(input_shape)) * 4)
+        self._outputs_memory = SharedMemory(create=True, size=int(np.prod(output_shape)) * 4)
+        self.inputs = np.ndarray(input_shape, dtype=np.float32, buffer=self._inputs_memory.buf)
+        self.outputs = np.ndarray(output_shape, dtype=np.float32, buffer=self._outputs_memory.buf)
+
+        self._connection, child_connection = context.Pipe()
+        self._process = context.Process(
+            target=_worker_main,
+            args=(
+                child_connection,
+                self._inputs_memory.name,
+                self._outputs_memory.name,
+                input_shape,
+                output_shape,
+                extractor_args,
+                extractor_options,
+                list(cores)
+            ),
+            daemon=True
+        )
+
+        try:
+            self._process.start()
+        except BaseException:
+            self._release_memory()
+            raise
+        finally:
+            child_connection.close()
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self._process.pid
+
+    def respawn(self) -> "_Worker":
+        return _Worker(*self._args)
+
+    def wait_ready(self) -> None:
+        self._reply()
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        size = len(batch)
+        self.inputs[:size] = batch
+        self.request(("run", size))
+        return self.outputs[:size].copy()
+
+    def request(self, message: Tuple) -> None:
+        try:
+            self._connection.send(message)
+        except OSError:
+            raise WorkerExitedError(f"The inference worker {self.pid} exited unexpectedly.")
+
+        self._reply()
+
+    def close(self) -> None:
+        try:
+            self._connection.send(None)
+        except OSError:
+            pass
+
+        self._process.join(timeout=5)
+        if self._process.is_alive():
+            self._process.kill()
+            self._process.join()
+
+        self._connection.close()
+        self._release_memory()
+
+    def _release_memory(self) -> None:
+        del self.inputs, self.outputs
+        for memory in (self._inputs_memory, self._outputs_memory):
+            memory.close()
+            memory.unlink()
+
+    def _reply(self) -> None:
+        try:
+            reply = self._connection.recv()
+        except (EOFError, OSError):
+            raise WorkerExitedError(f"The inference worker {self.pid} exited unexpectedly.")
+
+        if isinstance(reply, BaseException):
+            raise reply
+
+
+def _attach_memory(name: str) -> SharedMemory:
+    # The block belongs to another process: the resource tracker of this one must not unlink it at exit
+    memory = SharedMemory(name=name)
+    resource_tracker.unregister(memory._name, "shared_memory")  # noqa
+    return memory
+
+
+def _worker_main(
+        connection: Connection,
+        inputs_name: str,
+        outputs_name: str,
+        input_shape: Tuple[int, ...],
+        output_shape: Tuple[int, ...],
+        extractor_args: Tuple,
+        extractor_options: Dict[str, Any],
+        cores: List[int]
+) -> None:
+    pin_current_thread(cores)
+
+    try:
+        extractor = FeaturesExtractor(*extractor_args, **extractor_options)
+    except Exception as e:
+        connection.send(e)
+        return
+
+    inputs_memory = SharedMemory(name=inputs_name)
+    outputs_memory = SharedMemory(name=outputs_name)
+    inputs = np.ndarray(input_shape, dtype=np.float32, buffer=inputs_memory.buf)
+    outputs = np.ndarray(output_shape, dtype=np.float32, buffer=outputs_memory.buf)
+    connection.send("ready")
+
+    try:
+        while (message := connection.recv()) is not None:
+            try:
+                if message[0] == "run":
+                    size = message[1]
+                    outputs[:size] = extractor.backend.run(torch.from_numpy(inputs[:size]))
+                elif message[0] == "warmup":
+                    extractor.warmup(message[1], message[2])
+
+                connection.send(None)
+            except Exception as e:
+                connection.send(e)
+    except EOFError:
+        pass
+    finally:
+        del inputs, outputs
+        inputs_memory.close()
+        outputs_memory.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the model to every server process of the machine.")
+    parser.add_argument("address", help="Unix socket to listen on, e.g. /tmp/finder-inference.sock.")
+    parser.add_argument("--processes", type=int, default=1, help="Number of inference worker processes.")
+    parser.add_argument("--layer", choices=FeaturesExtractor.LAYERS, default="fc")
+    parser.add_argument("--backend", choices=list(BACKENDS), default="torch")
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=0, help="Inference threads split between the processes.")
+    parser.add_argument("--interop-threads", type=int, default=1)
+    parser.add_argument("--pin", action="store_true", help="Pin each process to its share of the cores (Linux).")
+    parser.add_argument("--warmup-passes", type=int, default=3)
+    parser.add_argument(
+        "--options", type=json.loads, default={}, help='Backend options as JSON, e.g. \'{"channels_last": true}\'.'
+    )
+    parser.add_argument(
+        "--calibration-dir", type=Path, default=None, help="Images sampled to calibrate and validate the int8 backend."
+    )
+    parser.add_argument("--calibration-size", type=int, default=64)
+    parser.add_argument("--validation-size", type=int, default=32)
+    args = parser.parse_args()
+
+    cores = available_cores()
+    threads = max(1, (args.threads or len(cores)) // args.processes)
+    options = dict(args.options)
+    # The extractor forwards its thread count to backends that size their own pool (ONNX Runtime)
+    intra_op_threads = options.pop("intra_op_threads", threads)
+    if args.backend == "int8" and args.calibration_dir is not None:
+        # Same sample as the API server takes from its images directory
+        library_images = sorted(list_files(args.calibration_dir, image_extensions))
+        sample = random.Random(0).sample(
+            library_images, min(args.calibration_size + args.validation_size, len(library_images))
+        )
+        options.setdefault("calibration_images", sample[:args.calibration_size])
+        options.setdefault("validation_images", sample[args.calibration_size:])
+
+    server = InferenceServer(
+        InferencePool(
+            args.processes,
+            args.layer,
+            args.backend,
+            max_batch_size=args.max_batch_size,
+            worker_cores=[cores[i * threads:(i + 1) * threads] for i in range(args.processes)] if args.pin else None,
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=args.interop_threads,
+            **options
+        ),
+        args.address,
+        authkey=os.getenv("INFERENCE_AUTHKEY", "").encode() or None
+    )
+
+    if args.warmup_passes:
+        server.pool.warmup(args.warmup_passes, sorted({1, args.max_batch_size}))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,140 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from typing import IO, Callable, Iterator, Optional, TypeVar
+
+from finder.utils.utils import FilePath
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+_R = TypeVar("_R")
+
+
+class OverloadedError(RuntimeError):
+    pass
+
+
+class BoundedExecutor:
+    # Thread pool for CPU bound work with backpressure: at most `max_pending` calls may be running or
+    # queued at once, and callers that cannot get a slot within `acquire_timeout` are rejected.
+
+    def __init__(
+            self,
+            max_workers: int,
+            max_pending: int,
+            *,
+            acquire_timeout: Optional[float] = 1.0,
+            thread_name_prefix: str = "",
+            initializer: Optional[Callable[[], None]] = None
+    ):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=thread_name_prefix, initializer=initializer
+        )
+        self.acquire_timeout = acquire_timeout
+        self._slots = asyncio.Semaphore(max(max_pending, max_workers))
+
+    async def run(self, func: Callable[..., _R], *args, **kwargs) -> _R:
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise OverloadedError("The server is too busy to process this request.")
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+        finally:
+            self._slots.release()
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ReadWriteLock:
+    # Many concurrent readers or a single writer; waiting writers block new readers so they cannot starve
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        with self._condition:
+            while self._writer or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+
+class FileLock:
+    # Exclusive advisory lock (flock) on a file, shared by every process of the machine and released by the
+    # OS when its holder exits. Without fcntl it only serializes the threads of the current process.
+
+    INTERPROCESS: bool = fcntl is not None
+
+    def __init__(self, path: FilePath):
+        self.path = Path(path)
+        self._thread_lock = threading.Lock()
+        self._file: Optional[IO] = None
+
+    @property
+    def held(self) -> bool:
+        return self._file is not None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if not self._thread_lock.acquire(blocking):
+            return False
+
+        file = open(self.path, "a")
+        try:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            file.close()
+            self._thread_lock.release()
+            return False
+
+        self._file = file
+        return True
+
+    def release(self) -> None:
+        # Closing the file releases the flock
+        self._file.close()
+        self._file = None
+        self._thread_lock.release()
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.release()
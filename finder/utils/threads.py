@@ -0,0 +1,83 @@
+import importlib.util
+import os
+from dataclasses import dataclass
+from typing import Optional, Sequence, Tuple
+
+
+def available_cores() -> Tuple[int, ...]:
+    # Honours CPU sets (containers, taskset) where the platform exposes them
+    if hasattr(os, "sched_getaffinity"):
+        return tuple(sorted(os.sched_getaffinity(0)))
+
+    return tuple(range(os.cpu_count() or 1))
+
+
+@dataclass(frozen=True)
+class ThreadBudget:
+    # How the cores are shared inside the server process so that thread pools do not oversubscribe them:
+    #   - inference: a single thread feeds the model, whose intra-op pool spreads each batch over
+    #     `inference_threads` cores (`interop_threads` for independent operators, rarely useful for a CNN);
+    #   - CPU workers: `cpu_workers` threads decode images, run similarity searches and hash;
+    #   - BLAS: NumPy matrix products of each worker use `blas_threads` threads. Workers already run
+    #     searches in parallel, so one thread each keeps their total at `cpu_workers`.
+    # The default profile gives half of the cores to inference and the other half to the workers.
+
+    cores: Tuple[int, ...]
+    inference_threads: int
+    interop_threads: int
+    cpu_workers: int
+    blas_threads: int
+
+    @classmethod
+    def default(
+            cls,
+            cores: Optional[Sequence[int]] = None,
+            *,
+            inference_threads: Optional[int] = None,
+            interop_threads: Optional[int] = None,
+            cpu_workers: Optional[int] = None,
+            blas_threads: Optional[int] = None
+    ) -> "ThreadBudget":
+        cores = tuple(cores) if cores is not None else available_cores()
+        inference_threads = inference_threads or max(1, len(cores) // 2)
+
+        return cls(
+            cores=cores,
+            inference_threads=inference_threads,
+            interop_threads=interop_threads or 1,
+            cpu_workers=cpu_workers or max(1, len(cores) - inference_threads),
+            blas_threads=blas_threads or 1
+        )
+
+    @property
+    def inference_cores(self) -> Tuple[int, ...]:
+        return self.cores[:self.inference_threads]
+
+    @property
+    def worker_cores(self) -> Tuple[int, ...]:
+        # With fewer cores than threads, workers share the inference cores rather than having none
+        return self.cores[self.inference_threads:] or self.cores
+
+    def __str__(self) -> str:
+        return (
+            f"{len(self.cores)} core(s): {self.inference_threads} inference thread(s) "
+            f"({self.interop_threads} inter-op), {self.cpu_workers} CPU worker(s) with {self.blas_threads} BLAS thread(s) each"
+        )
+
+
+def pin_current_thread(cores: Sequence[int]) -> None:
+    # On Linux the affinity of pid 0 is the one of the calling thread, and threads it spawns later
+    # (e.g. the model's intra-op pool) inherit it
+    if hasattr(os, "sched_setaffinity") and cores:
+        os.sched_setaffinity(0, cores)
+
+
+def limit_blas_threads(threads: int) -> bool:
+    # BLAS libraries read their thread count from the environment when they are loaded, which has already
+    # happened once NumPy is imported; threadpoolctl (optional) can still change it at runtime
+    if importlib.util.find_spec("threadpoolctl") is None:
+        return False
+
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=threads, user_api="blas")
+    return True
@@ -1,15 +1,17 @@
 import hashlib
 import inspect
 import io
+import os
 import re
 from functools import wraps
 from os import PathLike
 from pathlib import Path
-from typing import Union, Iterable, List, TypeAlias, FrozenSet, ParamSpec, TypeVar, Callable
+from typing import Union, Iterable, List, TypeAlias, FrozenSet, ParamSpec, TypeVar, Callable, Dict, Tuple
 
 from PIL import Image
 
 FilePath: TypeAlias = Union[str, Path, PathLike]
+FileSignature: TypeAlias = Tuple[int, int]  # (size, mtime_ns)
 image_extensions: FrozenSet[str] = frozenset(["png", "jpg", "jpeg"])
 
 
@@ -28,8 +30,41 @@ def list_files(directory: FilePath, extensions: Iterable[str] | str) -> List[Pat
     ]
 
 
-def bytes_to_hash(b: bytes) -> bytes:
-    return hashlib.sha256(b).digest()
+def scan_files(directory: FilePath, extensions: Iterable[str] | str) -> Dict[Path, FileSignature]:
+    directory = Path(directory)
+
+    if isinstance(extensions, str):
+        extensions = [extensions]
+
+    normalized_extensions = tuple(
+        ext if ext.startswith('.') else f".{ext}" for ext in extensions
+    )
+
+    # os.scandir reuses the directory listing to stat entries, which is much cheaper than Path.stat per file
+    signatures: Dict[Path, FileSignature] = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and Path(entry.name).suffix in normalized_extensions:
+                stat = entry.stat()
+                signatures[directory / entry.name] = (stat.st_size, stat.st_mtime_ns)
+
+    return signatures
+
+
+def diff_files(
+        previous: Dict[Path, FileSignature],
+        current: Dict[Path, FileSignature]
+) -> Tuple[List[Path], List[Path], List[Path]]:
+    added = [path for path in current if path not in previous]
+    changed = [path for path, signature in current.items() if path in previous and previous[path] != signature]
+    removed = [path for path in previous if path not in current]
+    return added, changed, removed
+
+
+def content_hasher() -> hashlib.blake2b:
+    # BLAKE2b is faster than SHA-256 in software, can be fed chunk by chunk while a download streams,
+    # and a 32 bytes digest keeps the 64 hex characters names of the images saved so far
+    return hashlib.blake2b(digest_size=32)
 
 
 def extract_name_extension(url: str, base_url: str) -> str | None:
@@ -0,0 +1,157 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+from pathlib import Path
+from typing import Callable, Iterable, Optional, Set
+
+from finder.utils.utils import FilePath
+
+# Constants from <sys/inotify.h>
+IN_CLOSE_WRITE: int = 0x00000008
+IN_MOVED_FROM: int = 0x00000040
+IN_MOVED_TO: int = 0x00000080
+IN_DELETE: int = 0x00000200
+IN_DELETE_SELF: int = 0x00000400
+IN_MOVE_SELF: int = 0x00000800
+IN_Q_OVERFLOW: int = 0x00004000
+IN_ISDIR: int = 0x40000000
+IN_NONBLOCK: int = 0o4000
+IN_CLOEXEC: int = 0o2000000
+
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+ChangesCallback = Callable[[Set[Path], Set[Path]], None]
+
+
+class DirectoryWatcher:
+    # Feeds filesystem events of a single directory (Linux inotify) into a callback.
+    # Events are debounced so a bulk copy results in a few batched calls instead of one per file;
+    # `max_delay` bounds how long a continuous stream of events can postpone a batch.
+    # When the directory itself is deleted or moved away the watch is closed and `on_lost` is called.
+
+    def __init__(
+            self,
+            directory: FilePath,
+            extensions: Iterable[str],
+            on_changes: ChangesCallback,
+            *,
+            on_overflow: Optional[Callable[[], None]] = None,
+            on_lost: Optional[Callable[[], None]] = None,
+            debounce: float = 0.5,
+            max_delay: float = 5.0
+    ):
+        self.directory = Path(directory)
+        self.extensions = tuple(ext if ext.startswith('.') else f".{ext}" for ext in extensions)
+        self.on_changes = on_changes
+        self.on_overflow = on_overflow
+        self.on_lost = on_lost
+        self.debounce = debounce
+        self.max_delay = max_delay
+
+        self._fd: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._changed: Set[Path] = set()
+        self._removed: Set[Path] = set()
+        self._first_event: Optional[float] = None
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def start(self) -> None:
+        libc = self._libc()
+
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+        if libc.inotify_add_watch(fd, os.fsencode(self.directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, f"inotify_add_watch failed for {self.directory}")
+
+        self._fd = fd
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(fd, self._read_events)
+
+    def close(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+    @staticmethod
+    def _libc() -> ctypes.CDLL:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available on this platform.")
+
+        return libc
+
+    def _read_events(self) -> None:
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += _EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped by the kernel, so the pending batch can no longer be trusted
+                self._changed.clear()
+                self._removed.clear()
+                if self.on_overflow is not None:
+                    self.on_overflow()
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # Events of a replaced directory would never arrive, so watching it is pointless
+                self.close()
+                if self.on_lost is not None:
+                    self.on_lost()
+                return
+
+            if mask & IN_ISDIR or not name:
+                continue
+
+            path = self.directory / os.fsdecode(name)
+            if path.suffix not in self.extensions:
+                continue
+
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self._changed.add(path)
+                self._removed.discard(path)
+
+            elif mask & (IN_MOVED_FROM | IN_DELETE):
+                self._removed.add(path)
+                self._changed.discard(path)
+
+        if self._changed or self._removed:
+            self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        now = self._loop.time()
+        if self._first_event is None:
+            self._first_event = now
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+
+        delay = max(0.0, min(self.debounce, self._first_event + self.max_delay - now))
+        self._flush_handle = self._loop.call_later(delay, self._flush)
+
+    def _flush(self) -> None:
+        changed, removed = self._changed, self._removed
+        self._changed, self._removed = set(), set()
+        self._first_event = None
+        self._flush_handle = None
+
+        self.on_changes(changed, removed)
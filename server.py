@@ -1,15 +1,19 @@
 import asyncio
 import os
+import random
+import threading
+import traceback
 import uuid
+from asyncio import Future
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from datetime import datetime
-from io import BytesIO
+from functools import partial
 from pathlib import Path
-from typing import Final, Dict, Optional, TypedDict
+from typing import Final, Dict, Optional, TypedDict, Any, Mapping, Set, Iterable, List
 
 import aiofiles
 import numpy as np
-from PIL import Image
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, HTTPException
 from pydantic import BaseModel
@@ -17,15 +21,37 @@ from starlette.middleware.cors import CORSMiddleware
 from starlette.responses import JSONResponse
 from starlette.staticfiles import StaticFiles
 
+from finder.index.base import VectorIndex
+from finder.index.factory import create_index
+from finder.index.flat import FlatIndex
+from finder.index.hnsw import HNSWIndex
+from finder.index.ivf import IVFIndex
+from finder.index.pq import PQIndex
+from finder.processing.batching import BatchingExtractor
+from finder.processing.caching import LRUCache, EmbeddingCache
 from finder.processing.features import FeaturesExtractor
-from finder.processing.loading import load_features, load_image_from_url
-from finder.processing.similarity import calc_similarities
-from finder.utils.utils import bytes_to_hash, list_files, image_extensions, extract_name_extension
+from finder.processing.fetching import ImageFetcher
+from finder.processing.loading import (
+    load_features, decode_image, decode_version, load_store_features, load_image_features, cache_features,
+    CachedFeatures
+)
+from finder.processing.matrix import FeatureMatrix
+from finder.processing.reduction import Projection, project_features
+from finder.processing.sharing import SharedFeatures
+from finder.processing.store import FeatureStore
+from finder.processing.workers import InferenceClient, InferencePool
+from finder.utils.concurrency import BoundedExecutor, OverloadedError, ReadWriteLock
+from finder.utils.utils import (
+    image_extensions, list_files, extract_name_extension, scan_files, diff_files, FileSignature, image_to_bytesio
+)
+from finder.utils.threads import ThreadBudget, limit_blas_threads, pin_current_thread
+from finder.utils.watcher import DirectoryWatcher
 
 
 class RequestCacheEntry(TypedDict):
     created: datetime
-    image: Image.Image
+    url: str
+    content: Optional[bytes]  # None when the features were reused from a cache
     hash: str
     features: np.ndarray
     saved: bool
@@ -33,20 +59,229 @@ class RequestCacheEntry(TypedDict):
     tweet_id: Optional[int]
 
 
+class UrlCacheEntry(TypedDict):
+    features: np.ndarray
+    hash: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
 @asynccontextmanager
 async def lifespan(_app: FastAPI):
+    # Warm the model up on its own thread before the server reports ready, so first requests do not pay for it
+    if INFERENCE_WARMUP_PASSES:
+        print("Warming up the model...")
+        await asyncio.get_running_loop().run_in_executor(
+            inference_batcher.executor,
+            features_extractor.warmup,
+            INFERENCE_WARMUP_PASSES,
+            sorted({1, inference_batcher.max_batch_size})
+        )
+
     asyncio.create_task(recurring_cleanup(60))
-    asyncio.create_task(recurring_images_update(2 * 60))
+
+    if shared_features is not None:
+        asyncio.create_task(follow_shared_images(SHARED_FEATURES_POLL))
+    else:
+        start_images_updates()
+
     yield
 
+    inference_batcher.close()
+    cpu_executor.shutdown()
+
+    if isinstance(features_extractor, (InferencePool, InferenceClient)):
+        features_extractor.close()
+    await image_fetcher.aclose()
+
+    if images_watcher is not None:
+        images_watcher.close()
+
+    if shared_features is not None:
+        shared_features.close()
+
+    await asyncio.to_thread(save_images_graph)
+
 
 load_dotenv()
 
 # Global constants and variables
 (IMAGES_DIR := Path(os.getenv("IMAGES_DIR_PATH"))).mkdir(exist_ok=True)
-(CACHE_DIR := Path(os.getenv("CACHE_DIR_PATH"))).mkdir(exist_ok=True)
-images: Dict[Path, np.ndarray] = {}
-features_extractor = FeaturesExtractor()
+# How the cores are shared between inference, the CPU worker pool and BLAS (see finder.utils.threads)
+thread_budget: Final[ThreadBudget] = ThreadBudget.default(
+    inference_threads=int(os.getenv("INFERENCE_THREADS", 0)) or None,
+    interop_threads=int(os.getenv("INFERENCE_INTEROP_THREADS", 0)) or None,
+    cpu_workers=int(os.getenv("CPU_WORKERS", 0)) or None,
+    blas_threads=int(os.getenv("BLAS_THREADS", 0)) or None
+)
+THREAD_PINNING: Final[bool] = os.getenv("THREAD_PINNING", "0") == "1"
+print(f"Thread budget: {thread_budget}{', pinned' if THREAD_PINNING else ''}.")
+if not limit_blas_threads(thread_budget.blas_threads):
+    print("threadpoolctl is not installed, BLAS threads can only be limited with OPENBLAS_NUM_THREADS/MKL_NUM_THREADS.")
+INFERENCE_BACKEND: Final[str] = os.getenv("INFERENCE_BACKEND", "torch")
+INFERENCE_MAX_BATCH_SIZE: Final[int] = int(os.getenv("INFERENCE_MAX_BATCH_SIZE", 16))
+# A machine-wide inference server (python -m finder.processing.workers) shared by every uvicorn worker, whose
+# layer and backend take precedence over EMBEDDING_LAYER and INFERENCE_BACKEND
+INFERENCE_ADDRESS: Final[Optional[str]] = os.getenv("INFERENCE_ADDRESS")
+# Otherwise, with inference worker processes (started by each uvicorn worker), each one gets an equal share of the
+# inference threads (and cores)
+INFERENCE_PROCESSES: Final[int] = int(os.getenv("INFERENCE_PROCESSES", 0))
+INFERENCE_PROCESS_THREADS: Final[int] = max(1, thread_budget.inference_threads // max(1, INFERENCE_PROCESSES))
+# ONNX Runtime sizes its own thread pool, ONNX_INTRA_OP_THREADS may set it apart from the thread budget
+ONNX_INTRA_OP_THREADS: Final[int] = int(os.getenv("ONNX_INTRA_OP_THREADS", 0)) if INFERENCE_BACKEND == "onnx" else 0
+INFERENCE_CHANNELS_LAST: Final[bool] = os.getenv("INFERENCE_CHANNELS_LAST", "0") == "1"
+# The int8 backend is calibrated on a fixed sample of the library, so that restarts quantize the model the same way,
+# and its drift is measured on other images of the library
+INT8_CALIBRATION_SIZE: Final[int] = int(os.getenv("INT8_CALIBRATION_SIZE", 64))
+INT8_VALIDATION_SIZE: Final[int] = int(os.getenv("INT8_VALIDATION_SIZE", 32))
+int8_sample: List[Path] = []
+if INFERENCE_BACKEND == "int8":
+    library_images = sorted(list_files(IMAGES_DIR, image_extensions))
+    int8_sample = random.Random(0).sample(
+        library_images, min(INT8_CALIBRATION_SIZE + INT8_VALIDATION_SIZE, len(library_images))
+    )
+INFERENCE_OPTIONS: Final[Dict[str, Any]] = {
+    "torch": {"channels_last": INFERENCE_CHANNELS_LAST},
+    "torchscript": {"cache_dir": os.getenv("TORCHSCRIPT_CACHE_DIR"), "channels_last": INFERENCE_CHANNELS_LAST},
+    "onnx": {"path": os.getenv("ONNX_MODEL_PATH")},
+    "int8": {
+        "calibration_images": int8_sample[:INT8_CALIBRATION_SIZE],
+        "validation_images": int8_sample[INT8_CALIBRATION_SIZE:]
+    },
+}.get(INFERENCE_BACKEND, {})
+features_extractor: FeaturesExtractor | InferencePool | InferenceClient
+if INFERENCE_ADDRESS:
+    features_extractor = InferenceClient(
+        INFERENCE_ADDRESS, authkey=os.getenv("INFERENCE_AUTHKEY", "").encode() or None
+    )
+elif INFERENCE_PROCESSES:
+    features_extractor = InferencePool(
+        INFERENCE_PROCESSES,
+        os.getenv("EMBEDDING_LAYER", "fc"),
+        INFERENCE_BACKEND,
+        max_batch_size=INFERENCE_MAX_BATCH_SIZE,
+        worker_cores=[
+            thread_budget.inference_cores[i * INFERENCE_PROCESS_THREADS:(i + 1) * INFERENCE_PROCESS_THREADS]
+            for i in range(INFERENCE_PROCESSES)
+        ] if THREAD_PINNING else None,
+        intra_op_threads=ONNX_INTRA_OP_THREADS or INFERENCE_PROCESS_THREADS,
+        inter_op_threads=thread_budget.interop_threads,
+        **INFERENCE_OPTIONS
+    )
+else:
+    features_extractor = FeaturesExtractor(
+        os.getenv("EMBEDDING_LAYER", "fc"),
+        INFERENCE_BACKEND,
+        intra_op_threads=ONNX_INTRA_OP_THREADS or thread_budget.inference_threads,
+        inter_op_threads=thread_budget.interop_threads,
+        **INFERENCE_OPTIONS
+    )
+CACHE_DIR_PATH: Final[str] = os.getenv("CACHE_DIR_PATH")
+FEATURE_STORE_PATH: Final[Optional[str]] = os.getenv("FEATURE_STORE_PATH")
+# Identifies the extracted features (model layer, then decode mode); features of each version are cached apart
+EXTRACTION_VERSION: Final[str] = f"{features_extractor.version}/{decode_version()}"
+FEATURES_SUBDIR: Path = Path(EXTRACTION_VERSION)
+# Optional dimensionality reduction between the model and the index, loaded from REDUCTION_PATH. A PCA
+# reads every stored feature to be fitted, so it is fitted offline rather than on every start
+REDUCTION_PATH: Final[Optional[str]] = os.getenv("REDUCTION_PATH")
+REDUCTION_DIM: Final[int] = int(os.getenv("REDUCTION_DIM", 0))
+REDUCTION_METHOD: Final[str] = os.getenv("REDUCTION_METHOD", "pca")
+reduction: Optional[Projection] = None
+if REDUCTION_PATH and Path(REDUCTION_PATH).exists():
+    reduction = Projection.load(REDUCTION_PATH, EXTRACTION_VERSION)
+elif REDUCTION_DIM and REDUCTION_METHOD == "random":
+    # A random projection needs no training, only the dimension of the features
+    reduction = Projection.fit(
+        np.empty((0, features_extractor.dim)), REDUCTION_DIM, "random", source=EXTRACTION_VERSION, seed=0
+    )
+    if REDUCTION_PATH:
+        reduction.save(REDUCTION_PATH)
+elif REDUCTION_DIM:
+    print(
+        f"No PCA projection found at REDUCTION_PATH, features are not reduced. Fit one on the extracted features with: "
+        f"python -m finder.processing.reduction {Path(FEATURE_STORE_PATH or CACHE_DIR_PATH) / FEATURES_SUBDIR} "
+        f"{REDUCTION_PATH or 'path/to/projection.npz'} --dim {REDUCTION_DIM} --source {EXTRACTION_VERSION}"
+    )
+FEATURES_VERSION: Final[str] = EXTRACTION_VERSION + (f"/{reduction.version}" if reduction else "")
+if reduction is not None:
+    FEATURES_SUBDIR /= reduction.version
+    print(f"Reducing features from {reduction.input_dim} to {reduction.dim} dimensions ({reduction.version}).")
+extract_features = project_features(features_extractor.extract_features, reduction)
+extract_features_batch = project_features(features_extractor.extract_features_batch, reduction)
+(CACHE_DIR := Path(CACHE_DIR_PATH) / FEATURES_SUBDIR).mkdir(parents=True, exist_ok=True)
+feature_store: Optional[FeatureStore] = FeatureStore(
+    Path(FEATURE_STORE_PATH) / FEATURES_SUBDIR, version=FEATURES_VERSION
+) if FEATURE_STORE_PATH else None
+INDEX_TYPE: Final[str] = os.getenv("INDEX_TYPE", "flat")
+FEATURES_DIM: Final[int] = reduction.dim if reduction is not None else features_extractor.dim
+# The HNSW graph is saved next to the features, so restarts only insert the images changed meanwhile
+HNSW_GRAPH_PATH: Final[Path] = Path(os.getenv("HNSW_GRAPH_PATH") or CACHE_DIR / "hnsw.npz")
+# Trained centroids and codebooks are checked against the features here, so a mismatch fails at startup
+INDEX_OPTIONS: Final[Dict[str, Any]] = {
+    "hnsw": {"graph": HNSW_GRAPH_PATH},
+    "ivf": {"centroids": os.getenv("IVF_CENTROIDS_PATH"), "dim": FEATURES_DIM},
+    "pq": {
+        "codebooks": os.getenv("PQ_CODEBOOKS_PATH"), "rerank": int(os.getenv("PQ_RERANK", 100)), "dim": FEATURES_DIM
+    },
+}.get(INDEX_TYPE, {})
+images: VectorIndex = create_index(INDEX_TYPE, **INDEX_OPTIONS)
+images_snapshot: Dict[Path, FileSignature] = {}
+images_lock = ReadWriteLock()
+images_update_lock = threading.Lock()
+IMAGES_UPDATE_MODE: Final[str] = os.getenv("IMAGES_UPDATE_MODE", "poll")
+images_watcher: Optional[DirectoryWatcher] = None
+# With several uvicorn workers, one of them loads the images and publishes their features to SHARED_FEATURES_DIR
+# (ideally on a tmpfs such as /dev/shm); the others map the published matrix read-only instead of loading their own
+SHARED_FEATURES_DIR: Final[Optional[str]] = os.getenv("SHARED_FEATURES_DIR")
+SHARED_FEATURES_POLL: Final[float] = float(os.getenv("SHARED_FEATURES_POLL", 5))
+# The loader publishes trained IVF centroids and PQ codebooks with the features, but an HNSW graph would be
+# rebuilt from scratch by every worker for every generation
+if SHARED_FEATURES_DIR and INDEX_TYPE == "hnsw":
+    print("SHARED_FEATURES_DIR is not supported by the hnsw index, each worker loads its own images.")
+shared_features: Optional[SharedFeatures] = SharedFeatures(
+    Path(SHARED_FEATURES_DIR) / FEATURES_SUBDIR
+) if SHARED_FEATURES_DIR and INDEX_TYPE != "hnsw" else None
+images_generation: Optional[int] = None  # generation of the shared features currently searched
+images_published: bool = True  # whether the shared features are up to date with the local index
+CPU_WORKERS: Final[int] = thread_budget.cpu_workers
+cpu_executor = BoundedExecutor(
+    CPU_WORKERS,
+    int(os.getenv("CPU_MAX_PENDING", 4 * CPU_WORKERS)),
+    acquire_timeout=float(os.getenv("CPU_QUEUE_TIMEOUT", 1)),
+    thread_name_prefix="cpu",
+    initializer=partial(pin_current_thread, thread_budget.worker_cores) if THREAD_PINNING else None
+)
+INFERENCE_WARMUP_PASSES: Final[int] = int(os.getenv("INFERENCE_WARMUP_PASSES", 3))
+# A single inference thread (one per worker process or server connection): the model parallelizes each batch internally
+INFERENCE_CONCURRENCY: Final[int] = (
+    1 if isinstance(features_extractor, FeaturesExtractor) else features_extractor.concurrency
+)
+inference_batcher = BatchingExtractor(
+    extract_features_batch,
+    max_batch_size=INFERENCE_MAX_BATCH_SIZE,
+    max_wait=float(os.getenv("INFERENCE_MAX_WAIT_MS", 5)) / 1000,
+    max_queue_size=int(os.getenv("INFERENCE_MAX_QUEUE_SIZE", 256)),
+    max_concurrent_batches=INFERENCE_CONCURRENCY,
+    executor=ThreadPoolExecutor(
+        max_workers=INFERENCE_CONCURRENCY,
+        thread_name_prefix="inference",
+        initializer=partial(pin_current_thread, thread_budget.inference_cores) if THREAD_PINNING else None
+    )
+)
+image_fetcher = ImageFetcher(
+    max_bytes=int(os.getenv("FETCH_MAX_BYTES", 20 * 1024 * 1024)),
+    connect_timeout=float(os.getenv("FETCH_CONNECT_TIMEOUT", 3)),
+    read_timeout=float(os.getenv("FETCH_READ_TIMEOUT", 10)),
+    max_connections_per_host=int(os.getenv("FETCH_MAX_CONNECTIONS_PER_HOST", 10))
+)
+# Features of recently queried URLs, reused while the server confirms the image is unchanged (304)
+url_cache: LRUCache[str, UrlCacheEntry] = LRUCache(int(os.getenv("URL_CACHE_SIZE", 10000)))
+# Features of recently seen images keyed by a hash of their encoded bytes, checked before decoding
+EMBEDDING_CACHE_DIR: Final[Optional[str]] = os.getenv("EMBEDDING_CACHE_DIR_PATH")
+embedding_cache = EmbeddingCache(
+    int(os.getenv("EMBEDDING_CACHE_SIZE", 10000)),
+    Path(EMBEDDING_CACHE_DIR) / FEATURES_SUBDIR if EMBEDDING_CACHE_DIR else None
+)
 requests_cache: Dict[str, RequestCacheEntry] = {}
 request_expire: int = 3 * 60
 
@@ -55,7 +290,14 @@ app: Final[FastAPI] = FastAPI(lifespan=lifespan)
 
 
 @app.get("/image/find")
-async def find_image(request: Request, url: str, max_results: int = 5, max_similarity: Optional[float] = None):
+async def find_image(
+        request: Request,
+        url: str,
+        max_results: int = 5,
+        max_similarity: Optional[float] = None,
+        ef_search: Optional[int] = None,
+        nprobe: Optional[int] = None
+):
     request_id = str(uuid.uuid1())
 
     if (file_name := extract_name_extension(url, str(request.base_url))) is not None:
@@ -83,8 +325,29 @@ async def find_image(request: Request, url: str, max_results: int = 5, max_simil
             }
         )
 
+    cached = url_cache.peek(url)
+    image, image_hash, features = None, None, None
+
     try:
-        image = load_image_from_url(url)
+        if cached is None:
+            fetched = await image_fetcher.fetch(url)
+        else:
+            fetched = await image_fetcher.fetch(url, etag=cached["etag"], last_modified=cached["last_modified"])
+
+        if fetched.not_modified:
+            url_cache.record_hit(url)
+            features, image_hash = cached["features"], cached["hash"]
+        else:
+            url_cache.record_miss()
+            image_hash = fetched.content_hash
+            features = await cpu_executor.run(embedding_cache.get, image_hash)
+
+            # Duplicate images skip both decoding and inference
+            if features is None:
+                image = await cpu_executor.run(decode_image, fetched.content)
+
+    except OverloadedError as e:
+        raise service_unavailable(e)
 
     except Exception as e:
         raise HTTPException(
@@ -96,9 +359,21 @@ async def find_image(request: Request, url: str, max_results: int = 5, max_simil
         )
 
     try:
-        features = features_extractor.extract_features(image)
+        if features is None:
+            features = await inference_batcher.extract(image)
+            await cpu_executor.run(embedding_cache.put, image_hash, features)
+
+        results = await cpu_executor.run(
+            search_images,
+            features,
+            top_k=max_results,
+            max_similarity=max_similarity,
+            ef_search=ef_search,
+            nprobe=nprobe
+        )
+    except OverloadedError as e:
+        raise service_unavailable(e)
 
-        results = calc_similarities(features, images, max_similarity=max_similarity)[:max_results]
     except Exception as e:
         raise HTTPException(
             status_code=400,
@@ -108,12 +383,23 @@ async def find_image(request: Request, url: str, max_results: int = 5, max_simil
             }
         )
 
-    image_hash = bytes_to_hash(image.tobytes()).hex()
+    # Only responses carrying a validator can be revalidated later
+    if not fetched.not_modified:
+        if fetched.etag is not None or fetched.last_modified is not None:
+            url_cache.put(url, {
+                "features": features,
+                "hash": image_hash,
+                "etag": fetched.etag,
+                "last_modified": fetched.last_modified
+            })
+        else:
+            url_cache.pop(url)
 
     is_exact_match = bool(results) and results[0][1] >= 0.99
 
     requests_cache[request_id] = {
-        "image": image,
+        "url": url,
+        "content": fetched.content,
         "hash": image_hash,
         "features": features,
         "created": datetime.now(),
@@ -164,7 +450,9 @@ async def save_image(request: Request, save_request: SaveRequest):
 
     url = f"{request.base_url}image/{save_path.name}"
 
-    if save_path.exists() and features_save_path.exists():
+    features_saved = save_path in images if feature_store is not None else features_save_path.exists()
+
+    if save_path.exists() and features_saved:
         raise HTTPException(
             status_code=409,
             detail={
@@ -174,16 +462,38 @@ async def save_image(request: Request, save_request: SaveRequest):
             }
         )
 
-    with BytesIO() as byte_io:
-        cache["image"].save(byte_io, format="JPEG")
-        img_bytes = byte_io.getvalue()
+    try:
+        # Features reused from a cache never downloaded the image, so it is downloaded now
+        # (the file is still named after the content hash computed by /image/find)
+        if cache["content"] is None:
+            cache["content"] = (await image_fetcher.fetch(cache["url"])).content
+
+        # Queries are decoded at reduced resolution, so the stored copy is decoded again at full size
+        img_bytes = await cpu_executor.run(
+            lambda: image_to_bytesio(decode_image(cache["content"], draft_size=None)).getvalue()
+        )
+    except OverloadedError as e:
+        raise service_unavailable(e)
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": str(e),
+                "message": f"Failed to load image from the provided URL: {str(e)}.",
+            }
+        )
 
     async with aiofiles.open(save_path, "wb") as img_file:
         await img_file.write(img_bytes)
 
-    np.save(features_save_path, cache["features"])
+    # With a feature store, adding to the index already appends the vector to the store
+    if feature_store is None:
+        np.save(features_save_path, cache["features"])
 
-    images[save_path] = cache["features"]
+    # Workers following the shared features only write the file, the loader picks it up on its next update
+    if shared_features is None or shared_features.is_loader:
+        await asyncio.to_thread(add_image, save_path, cache["features"])
     cache["saved"] = True
 
     if cache["saved"] and cache["tweeted"]:
@@ -198,6 +508,11 @@ async def save_image(request: Request, save_request: SaveRequest):
     )
 
 
+@app.get("/cache/stats")
+async def cache_stats():
+    return JSONResponse(status_code=200, content={"url": url_cache.stats(), "embedding": embedding_cache.stats()})
+
+
 # Middlewares
 # noinspection PyTypeChecker
 app.add_middleware(
@@ -213,18 +528,244 @@ app.mount("/image", StaticFiles(directory=IMAGES_DIR, html=True), name="image")
 
 
 # Helper functions
-def update_images():
-    global images, features_extractor
+def service_unavailable(e: OverloadedError) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail={
+            "error": "Service Unavailable",
+            "message": f"{str(e)} Please retry later."
+        }
+    )
+
+
+def search_images(features: np.ndarray, **kwargs):
+    with images_lock.read():
+        return images.search(features, **kwargs)
+
+
+def add_image(path: Path, vector: np.ndarray):
+    global images_published
+
+    with images_lock.write():
+        images.add(path, vector)
+        images_published = False
 
-    if len(images) == len(list_files(IMAGES_DIR, image_extensions)):
+
+def update_images():
+    global images, images_snapshot, images_published
+
+    # Updates run in worker threads, one at a time; the index itself is guarded by images_lock
+    with images_update_lock:
+        current = scan_files(IMAGES_DIR, image_extensions)
+
+        if not images_snapshot:
+            print("Loading images...")
+            vectors = load_vectors()
+
+            if INDEX_TYPE == "hnsw":
+                # Inserting into the graph takes a while for every image it does not hold yet, meanwhile the
+                # vectors are searched exhaustively. Both indexes share them, so the images saved meanwhile
+                # are inserted by sync.
+                vectors = vectors if isinstance(vectors, FeatureMatrix) else FeatureMatrix(vectors)
+                with images_lock.write():
+                    images = FlatIndex(vectors)
+                print(f"{len(images)} image(s) loaded, searched exhaustively until the HNSW graph is ready...")
+
+            index = create_images_index(vectors)
+            with images_lock.write():
+                if isinstance(index, HNSWIndex):
+                    index.sync()
+                images = index
+                images_published = False
+            images_snapshot = current
+            print(f"{len(images)} image(s) loaded!")
+
+            save_images_graph()
+        else:
+            added, changed, removed = diff_files(images_snapshot, current)
+            apply_image_changes(added + changed, removed, current)
+
+
+def update_watched_images(changed: Set[Path], removed: Set[Path]):
+    current = {}
+    for path in changed:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            removed.add(path)
+            continue
+        current[path] = (stat.st_size, stat.st_mtime_ns)
+
+    with images_update_lock:
+        apply_image_changes(current.keys(), removed, current)
+
+
+def apply_image_changes(changed: Iterable[Path], removed: Iterable[Path], current: Dict[Path, FileSignature]):
+    global images_snapshot, images_published
+
+    removed = set(removed)
+    added, refreshed = [], []
+
+    for path in changed:
+        if path not in current:
+            continue
+
+        if path not in images:
+            added.append(path)
+
+        # Images stored through /image/save are already indexed, they only need to join the snapshot
+        elif path in images_snapshot and images_snapshot[path] != current[path]:
+            refreshed.append(path)
+
+    # Added and refreshed images only join the snapshot once they are indexed (see below)
+    pending = set(added) | set(refreshed)
+    images_snapshot = {
+        path: signature for path, signature in {**images_snapshot, **current}.items()
+        if path not in removed and path not in pending
+    } | {path: images_snapshot[path] for path in refreshed}
+
+    removed = [path for path in removed if path in images]
+
+    if not (added or refreshed or removed):
         print("No images update was required.")
         return
 
-    print("Loading images...")
-    images = load_features(IMAGES_DIR, CACHE_DIR, features_extractor.extract_features)
+    print(f"Updating images ({len(added)} added, {len(refreshed)} changed, {len(removed)} removed)...")
+
+    with images_lock.write():
+        for path in removed:
+            images.remove(path)
+        images_published = False
+
+    # Features are computed outside of the lock so searches are only blocked for the insertion itself
+    for path, refresh in [(path, False) for path in added] + [(path, True) for path in refreshed]:
+        try:
+            vector = load_image_vector(path, refresh=refresh)
+        except Exception as e:
+            # Its previous signature (if any) stays in the snapshot, so the next update tries it again,
+            # e.g. once a file that was still being copied is complete
+            print(f"Could not load {path.name} ({e!r}), it will be retried on the next update.")
+            continue
+
+        add_image(path, vector)
+        images_snapshot[path] = current[path]
+
     print(f"{len(images)} image(s) loaded!")
 
 
+def publish_images():
+    global images_generation, images_published
+
+    if shared_features is None or not shared_features.is_loader or images_published:
+        return
+
+    # Only the copy of the features is made under the lock, writing them would block updates (and searches
+    # queued behind them) for as long as the whole matrix takes to write
+    with images_lock.read():
+        # PQ only keeps compressed codes, its raw vectors are published instead
+        snapshot = shared_features.snapshot(images.raw_vectors if isinstance(images, PQIndex) else images.vectors)
+        trained = trained_index_options(images)
+        images_published = True
+
+    try:
+        images_generation = shared_features.publish(snapshot, trained)
+    except BaseException:
+        images_published = False
+        raise
+
+    print(f"Published {len(images)} image(s) as shared generation {images_generation}.")
+
+
+def save_images_graph():
+    # Like publications, only the copy of the graph is made under the lock
+    with images_lock.read():
+        if not isinstance(images, HNSWIndex) or not images.modified:
+            return
+        snapshot = images.snapshot()
+
+    try:
+        HNSWIndex.write(HNSW_GRAPH_PATH, snapshot)
+    except OSError as e:
+        print(f"Could not save the HNSW graph to {HNSW_GRAPH_PATH} ({e!r}).")
+        return
+
+    print(f"Saved the HNSW graph of {len(snapshot['paths'])} node(s) to {HNSW_GRAPH_PATH}.")
+
+
+def attach_shared_images(generation: int):
+    global images, images_generation
+
+    # The index is built aside and swapped in at once, searches keep using the previous generation meanwhile
+    index = create_images_index(shared_features.attach(generation, IMAGES_DIR), **shared_features.trained(generation))
+    with images_lock.write():
+        images = index
+        images_generation = generation
+
+    print(f"Attached {len(images)} image(s) of shared generation {generation}.")
+
+
+def load_image_vector(path: Path, *, refresh: bool = False) -> np.ndarray:
+    # With a feature store the index persists the vector itself, otherwise it goes to the .npy cache
+    cache_file = CACHE_DIR / f"{path.name}.npy"
+    use_cache = feature_store is None and not refresh and cache_file.exists()
+
+    return load_image_features(
+        path,
+        CACHE_DIR,
+        extract_features,
+        cache_file=cache_file if use_cache else None,
+        save_cache=feature_store is None
+    )
+
+
+def load_vectors() -> Mapping[Path, np.ndarray]:
+    if feature_store is not None:
+        return load_store_features(
+            IMAGES_DIR,
+            feature_store,
+            extract_features,
+            batch_extract_func=extract_features_batch
+        )
+
+    if INDEX_TYPE == "pq":
+        # PQ only reads each raw vector once to encode it, so they are read lazily from the .npy cache
+        # instead of all being loaded at once
+        paths = cache_features(IMAGES_DIR, CACHE_DIR, extract_features, batch_extract_func=extract_features_batch)
+        return CachedFeatures(CACHE_DIR, paths)
+
+    return load_features(
+        IMAGES_DIR,
+        CACHE_DIR,
+        extract_features,
+        batch_extract_func=extract_features_batch
+    )
+
+
+def create_images_index(vectors: Optional[Mapping[Path, np.ndarray]] = None, **trained: np.ndarray) -> VectorIndex:
+    # Trained structures (see trained_index_options) replace the paths of INDEX_OPTIONS
+    options = {**INDEX_OPTIONS, **trained}
+
+    if INDEX_TYPE == "pq":
+        # PQ keeps only compressed codes in memory and re-ranks with raw vectors read from disk. A loader keeps
+        # them in memory instead, otherwise every publication would read back each .npy file
+        if shared_features is not None and not isinstance(vectors, FeatureMatrix):
+            vectors = FeatureMatrix(vectors)
+
+        options["raw_vectors"] = vectors if isinstance(vectors, FeatureMatrix) else CachedFeatures(CACHE_DIR)
+
+    return create_index(INDEX_TYPE, vectors, **options)
+
+
+def trained_index_options(index: VectorIndex) -> Dict[str, np.ndarray]:
+    # Published with the shared features, so that the other workers do not run k-means again on every generation
+    if isinstance(index, IVFIndex) and index.trained:
+        return {"centroids": index.centroids}
+    if isinstance(index, PQIndex) and index.trained:
+        return {"codebooks": index.codebooks}
+
+    return {}
+
+
 def cleanup_expired_requests():
     global requests_cache
 
@@ -242,7 +783,106 @@ async def recurring_cleanup(cooldown: float):
         cleanup_expired_requests()
 
 
+def start_images_updates():
+    if IMAGES_UPDATE_MODE == "inotify":
+        asyncio.create_task(watch_images())
+    else:
+        asyncio.create_task(recurring_images_update(2 * 60))
+
+
+async def follow_shared_images(cooldown: float):
+    global shared_features
+
+    while True:
+        # Followers keep trying to take the lock, so one of them takes over when the loader exits
+        try:
+            became_loader = shared_features.try_become_loader()
+        except OSError as e:
+            print(f"Could not share the features ({e}), this worker loads its own images.")
+            shared_features = None
+            start_images_updates()
+            return
+
+        if became_loader:
+            print(f"This worker loads the images and publishes them to {shared_features.directory}.")
+            start_images_updates()
+            asyncio.create_task(publish_shared_images(cooldown))
+            return
+
+        generation = shared_features.current_generation()
+        if generation is not None and generation != images_generation:
+            try:
+                await asyncio.to_thread(attach_shared_images, generation)
+            except FileNotFoundError:
+                # Superseded and removed while attaching, the next generation is picked up instead
+                pass
+
+        await asyncio.sleep(cooldown)
+
+
+async def publish_shared_images(cooldown: float):
+    # Changes are published at most once per cooldown, so a burst of them costs the other workers a single
+    # generation to attach rather than one per image
+    while True:
+        await asyncio.sleep(cooldown)
+
+        try:
+            await asyncio.to_thread(publish_images)
+        except Exception as e:
+            print(f"Publishing the images failed: {e!r}")
+            traceback.print_exc()
+
+
+async def watch_images():
+    global images_watcher
+
+    # The watch starts before the initial scan, which may extract features for hours on a cold start: changes
+    # made meanwhile wait for it behind images_update_lock instead of being missed
+    loop = asyncio.get_running_loop()
+    images_watcher = DirectoryWatcher(
+        IMAGES_DIR,
+        image_extensions,
+        lambda changed, removed: loop.run_in_executor(
+            None, update_watched_images, changed, removed
+        ).add_done_callback(report_update_failure),
+        on_overflow=lambda: loop.run_in_executor(None, update_images).add_done_callback(report_update_failure),
+        on_lost=lambda: loop.create_task(poll_lost_images())
+    )
+
+    try:
+        images_watcher.start()
+        print(f"Watching {IMAGES_DIR} for image changes.")
+    except OSError as e:
+        print(f"Could not watch {IMAGES_DIR} ({e}), falling back to polling.")
+        images_watcher = None
+        await recurring_images_update(2 * 60)
+        return
+
+    await asyncio.to_thread(update_images)
+
+
+async def poll_lost_images():
+    global images_watcher
+
+    # Polling scans the directory by path, so it also picks up a directory that was deleted and created again
+    print(f"{IMAGES_DIR} was deleted or moved, falling back to polling.")
+    images_watcher = None
+    await recurring_images_update(2 * 60)
+
+
 async def recurring_images_update(cooldown: float):
     while True:
-        update_images()
+        try:
+            await asyncio.to_thread(update_images)
+        except Exception as e:
+            print(f"Images update failed: {e!r}")
+            traceback.print_exc()
+
         await asyncio.sleep(cooldown)
+
+
+def report_update_failure(future: Future):
+    # Updates triggered by the watcher run in executor futures nobody awaits, so their errors are reported here
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Images update failed: {future.exception()!r}")
+        traceback.print_exception(future.exception())
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+torchvision = pytest.importorskip("torchvision")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from finder.backends.onnx_runtime import OnnxBackend  # noqa: E402
+from finder.backends.pytorch import TorchBackend  # noqa: E402
+from finder.processing.features import FeaturesExtractor, preprocess_images  # noqa: E402
+from finder.processing.similarity import compare_features  # noqa: E402
+
+# A smaller input keeps the export and the comparison fast, the network itself is the full ResNet-50
+INPUT_SIZE = (64, 64)
+
+
+@pytest.fixture(scope="module")
+def model() -> torch.nn.Module:
+    # Random weights: nothing is downloaded, and the comparison does not depend on the trained values
+    torch.manual_seed(0)
+    return torchvision.models.resnet50(weights=None).eval()
+
+
+@pytest.fixture
+def batch() -> torch.Tensor:
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(4, 3, *INPUT_SIZE, generator=generator)
+
+
+@pytest.mark.parametrize("layer", ["fc", "avgpool", "layer2"])
+def test_onnx_matches_pytorch(model, batch, layer, tmp_path):
+    truncated = FeaturesExtractor._truncate(model, layer).eval()
+    version = FeaturesExtractor.version_of(layer)
+    options = {"version": version, "device": torch.device("cpu"), "preprocess": preprocess_images}
+
+    expected = TorchBackend(truncated, **options).run(batch)
+    actual = OnnxBackend(truncated, path=tmp_path / "model.onnx", input_size=INPUT_SIZE, **options).run(batch)
+
+    assert actual.shape == expected.shape == (batch.shape[0], FeaturesExtractor.LAYER_DIMS[layer])
+    np.testing.assert_allclose(actual, expected, rtol=1e-3, atol=1e-4)
+
+    metrics = compare_features(expected, actual)
+    assert metrics["min_cosine"] > 0.9999
+    assert metrics["top1_agreement"] == 1.0
+
+
+def test_onnx_export_is_reused_and_replaced_for_another_version(model, batch, tmp_path):
+    path = tmp_path / "model.onnx"
+    options = {"device": torch.device("cpu"), "preprocess": preprocess_images, "path": path, "input_size": INPUT_SIZE}
+
+    OnnxBackend(model, version="resnet50-fc", **options)
+    exported = path.stat().st_mtime_ns
+
+    OnnxBackend(model, version="resnet50-fc", **options)
+    assert path.stat().st_mtime_ns == exported
+
+    # A different feature version must not reuse the previous export
+    avgpool = FeaturesExtractor._truncate(model, "avgpool").eval()
+    backend = OnnxBackend(avgpool, version="resnet50-avgpool", **options)
+    assert backend.run(batch).shape == (batch.shape[0], FeaturesExtractor.LAYER_DIMS["avgpool"])
+
+
+def test_extractor_gives_its_thread_count_to_onnx_runtime(monkeypatch, tmp_path):
+    from finder.processing import features
+
+    # A fresh extractor with random weights, whatever the other tests created
+    monkeypatch.setattr(FeaturesExtractor, "_PROCESSOR", None)
+    monkeypatch.setattr(features, "resnet50", lambda weights: torchvision.models.resnet50(weights=None))
+    threads = torch.get_num_threads()
+
+    try:
+        extractor = FeaturesExtractor("avgpool", "onnx", intra_op_threads=2, path=tmp_path / "model.onnx")
+    finally:
+        torch.set_num_threads(threads)
+
+    assert extractor.backend.session.get_session_options().intra_op_num_threads == 2